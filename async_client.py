@@ -0,0 +1,398 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from communication import MAX_FRAME_SIZE, AsyncCommunicationProtocol
+
+
+class AsyncClient:
+    """
+    Programmatic asyncio client for a single server connection.
+
+    Commands and field values are sent pipelined with request ids, so a whole
+    interaction (e.g. log in with username and password) takes a single round trip.
+
+    The session token the server issues on login is kept, and presented when the
+    client connects again, so the new connection starts out logged in.
+    """
+
+    def __init__(self, host, port, compression_threshold=4096, session_token=None, max_frame_size=MAX_FRAME_SIZE):
+        self.host = host
+        self.port = port
+        self.compression_threshold = compression_threshold
+        self.max_frame_size = max_frame_size
+        self.session_token = session_token
+        self.com_protocol = None
+        self.greeting = []
+        self.commands = {}
+        self.username = None
+        self._request_id = 0
+        self._resuming = False
+
+    @property
+    def is_connected(self):
+        return self.com_protocol is not None and not self.com_protocol.writer.is_closing()
+
+    @property
+    def is_admin(self):
+        return "users" in self.commands or "user info -a" in self.commands
+
+    async def connect(self):
+        """
+        Connect to the server, negotiate the codec and wait for the main menu. With a
+        session token, wait for the server to resume the session; if it refuses, the
+        token is dropped and the client stays logged out.
+
+        Raises:
+            ConnectionError: If the server can't be reached or closes the connection
+        """
+        self.com_protocol = await AsyncCommunicationProtocol.open_connection(
+            self.host, self.port, compression_threshold=self.compression_threshold, max_frame_size=self.max_frame_size)
+        self.greeting = []
+        self._resuming = False
+        # the logged-out menu is sent before the server has read the token, the resumed one after it
+        menus = 0
+        while True:
+            message = await self.receive()
+            if message.get("status") == "ready_for_input":
+                menus += 1
+                if menus == (2 if self._resuming else 1):
+                    self._resuming = False
+                    return
+                continue
+            if message.get("status") == "error" and self._resuming:
+                self.session_token = None
+            self.greeting.append(message)
+
+    async def close(self):
+        """Close the connection with a close/ack exchange"""
+        if self.is_connected:
+            await self.com_protocol.close_gracefully_async()
+        self.username = None
+
+    async def send(self, message):
+        """
+        Send a single request without waiting for the response.
+
+        Returns:
+            int: The request id the server's responses will carry
+        """
+        request_id = self._queue(message)
+        await self.com_protocol.flush_async()
+        return request_id
+
+    def _queue(self, message):
+        self._request_id += 1
+        self.com_protocol.queue(self.com_protocol.format_message(message, request_id=self._request_id))
+        return self._request_id
+
+    async def receive(self):
+        """
+        Receive the next message from the server. Handshake offers and close
+        frames are answered transparently.
+
+        Raises:
+            ConnectionError: If the connection is lost
+        """
+        message = await self.com_protocol.receive_async()
+        status = message.get("status")
+        if status == "handshake":
+            answer = self.com_protocol.handshake_answer(message, self.session_token)
+            await self.com_protocol.send_async(answer)
+            self.com_protocol.accept_handshake(answer)
+            self._resuming = self.session_token is not None
+        elif status == "close":
+            await self.com_protocol.acknowledge_close_async()
+        content, display_type = self._payload(message)
+        if display_type == "list":
+            self.commands = content
+        elif display_type == "session":
+            self.username = content["username"]
+            self.session_token = content["token"]
+        return message
+
+    @staticmethod
+    def _payload(message):
+        """Return the (content, display type) pair carried by a message, if any"""
+        data = message.get("data")
+        if isinstance(data, (list, tuple)) and len(data) == 2:
+            return data
+        return None, None
+
+    async def request(self, *messages):
+        """
+        Send the messages back to back and collect the server's responses to each one.
+
+        Returns:
+            list: One list of response messages per sent message
+
+        Raises:
+            ConnectionError: If the server closes the connection before answering
+        """
+        request_ids = [self._queue(message) for message in messages]
+        await self.com_protocol.flush_async()
+        responses = {request_id: [] for request_id in request_ids}
+        pending = set(request_ids)
+        while pending:
+            message = await self.receive()
+            status = message.get("status")
+            if status == "close":
+                raise ConnectionError("Server closed the connection")
+            if status == "handshake":
+                continue
+            request_id = message.get("id")
+            if request_id not in responses:
+                continue
+            if status == "ready_for_input":
+                pending.discard(request_id)
+            else:
+                responses[request_id].append(message)
+        return [responses[request_id] for request_id in request_ids]
+
+    @staticmethod
+    def _raise_for_errors(responses):
+        for message in responses:
+            if message.get("status") == "error":
+                raise ValueError(message.get("message"))
+
+    async def _enter_user_management(self):
+        if "user info -a" not in self.commands:
+            if "users" not in self.commands:
+                raise PermissionError("User management requires an administrator account")
+            await self.request("users")
+
+    async def login(self, username, password):
+        """
+        Log in on this connection.
+
+        Raises:
+            ValueError: If the credentials are incorrect. The server keeps asking for
+                credentials after a failed attempt, so the connection is reopened.
+        """
+        *_, responses = await self.request("log in", username, password)
+        if any(message.get("status") == "error" for message in responses):
+            self.session_token = None
+            await self.close()
+            await self.connect()
+            raise ValueError("Incorrect username or password!")
+        self.username = username
+        return True
+
+    async def register(self, username, password, email, role="user"):
+        """
+        Register a new account. Administrators can also choose the account's role.
+
+        Raises:
+            ValueError: If the server rejects the registration
+        """
+        if self.username is None:
+            *_, responses = await self.request("register", username, password, email)
+        else:
+            await self._enter_user_management()
+            *_, responses = await self.request("add", username, password, email, role)
+        self._raise_for_errors(responses)
+        return True
+
+    async def get_user(self, username=None):
+        """
+        Fetch a single user record. Regular users can only fetch their own record.
+
+        Returns:
+            dict: The user record keyed by username
+
+        Raises:
+            ValueError: If the user doesn't exist
+        """
+        if self.is_admin:
+            await self._enter_user_management()
+            *_, responses = await self.request("user info", username or self.username)
+        else:
+            responses, = await self.request("info")
+        self._raise_for_errors(responses)
+        return self._table(responses)
+
+    async def list_users(self):
+        """
+        Fetch all user records (administrators only). The server streams them a page
+        per frame; the pages are merged here.
+
+        Returns:
+            dict: User records keyed by username
+        """
+        await self._enter_user_management()
+        responses, = await self.request("user info -a")
+        self._raise_for_errors(responses)
+        return self._table(responses)
+
+    async def list_users_page(self, page_size=50, cursor=None):
+        """
+        Fetch a single page of user records (administrators only).
+
+        Args:
+            page_size (int): Maximum number of records on the page
+            cursor (str, optional): Cursor returned with the previous page
+
+        Returns:
+            tuple: User records keyed by username, and the cursor of the next page
+                (None on the last page)
+        """
+        await self._enter_user_management()
+        *_, responses = await self.request("user info -p", str(page_size), cursor or "")
+        self._raise_for_errors(responses)
+        next_cursor = None
+        for message in responses:
+            content, display_type = self._payload(message)
+            if display_type == "page":
+                next_cursor = content["next_cursor"]
+        return self._table(responses), next_cursor
+
+    async def find_users(self, role=None, email_prefix=None, limit=50):
+        """
+        Fetch the users with a role and/or email prefix (administrators only).
+
+        Returns:
+            dict: Matching user records keyed by username
+
+        Raises:
+            ValueError: If the server rejects the filter
+        """
+        await self._enter_user_management()
+        *_, responses = await self.request("filter", role or "", email_prefix or "", str(limit))
+        self._raise_for_errors(responses)
+        return self._table(responses)
+
+    async def import_users(self, path):
+        """
+        Import users from a JSONL or CSV file on the server (administrators only).
+
+        Returns:
+            str: The server's import report
+
+        Raises:
+            ValueError: If the import fails
+        """
+        await self._enter_user_management()
+        *_, responses = await self.request("import", path)
+        self._raise_for_errors(responses)
+        return "\n".join(message.get("message") for message in responses)
+
+    async def delete_users(self, pattern):
+        """
+        Delete all users matching a shell-style pattern (administrators only).
+
+        Returns:
+            str: The server's report
+        """
+        await self._enter_user_management()
+        *_, responses = await self.request("delete -p", pattern)
+        self._raise_for_errors(responses)
+        if not any(self._payload(message)[1] == "confirm" for message in responses):
+            return responses[-1].get("message")
+        responses, = await self.request("Y")
+        self._raise_for_errors(responses)
+        return responses[-1].get("message")
+
+    @staticmethod
+    def _table(responses):
+        """Merge the table rows carried by the responses"""
+        table = {}
+        for message in responses:
+            content, display_type = AsyncClient._payload(message)
+            if display_type in ("tabular", "rows"):
+                table.update(content)
+            elif display_type == "page":
+                table.update(content["users"])
+        return table
+
+
+class ClientPool:
+    """
+    Pool of authenticated connections for running many concurrent sessions from one
+    process. Connections are opened lazily, up to the pool size, and reused. Only the
+    first connection logs in; the others resume its session with the session token.
+    """
+
+    def __init__(self, host, port, username=None, password=None, size=10, **client_options):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.size = size
+        self.client_options = client_options
+        self.session_token = None
+        self._idle = asyncio.LifoQueue()
+        self._clients = set()
+
+    async def _open_client(self):
+        """Open a connection, resuming the pool's session if there is one and logging in otherwise"""
+        client = AsyncClient(self.host, self.port, session_token=self.session_token, **self.client_options)
+        await client.connect()
+        if self.username is not None and client.username != self.username:
+            await client.login(self.username, self.password)
+            self.session_token = client.session_token
+        return client
+
+    async def acquire(self):
+        """Take an idle connection from the pool, opening a new one if the pool isn't full"""
+        while True:
+            if not self._idle.empty() or len(self._clients) >= self.size:
+                client = await self._idle.get()
+                if client.is_connected:
+                    return client
+                self._clients.discard(client)
+                continue
+            placeholder = object()
+            self._clients.add(placeholder)
+            try:
+                client = await self._open_client()
+            finally:
+                self._clients.discard(placeholder)
+            self._clients.add(client)
+            return client
+
+    def release(self, client):
+        """Return a connection to the pool"""
+        if client.is_connected:
+            self._idle.put_nowait(client)
+        else:
+            self._clients.discard(client)
+
+    @asynccontextmanager
+    async def connection(self):
+        """Borrow a connection for the duration of the block"""
+        client = await self.acquire()
+        try:
+            yield client
+        finally:
+            self.release(client)
+
+    async def run(self, operation, count):
+        """
+        Run an operation concurrently on up to size connections.
+
+        Args:
+            operation: Coroutine function taking an AsyncClient and an index
+            count (int): Number of times to run the operation
+
+        Returns:
+            list: Results (or exceptions) in the order of the indices
+        """
+        async def run_one(index):
+            async with self.connection() as client:
+                return await operation(client, index)
+        return await asyncio.gather(*(run_one(index) for index in range(count)), return_exceptions=True)
+
+    async def close(self):
+        """Close all pooled connections"""
+        while not self._idle.empty():
+            client = self._idle.get_nowait()
+            try:
+                await client.close()
+            except OSError as e:
+                logging.error(f"Error closing pooled connection: {e}")
+            self._clients.discard(client)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        await self.close()
@@ -0,0 +1,64 @@
+import hashlib
+import math
+
+
+class CountingBloomFilter:
+    """
+    Set membership test that answers "definitely not present" or "possibly present"
+    in a fixed amount of memory, whatever the size of the keys.
+
+    Each key sets hash_count of size counters. A key is possibly present when all of
+    its counters are non-zero, so lookups of keys never added come back negative
+    except for a false positive rate of about error_rate while the filter holds up to
+    capacity keys. Counters instead of bits let keys be removed again. A counter that
+    reaches 255 stays there, since it no longer knows how many keys share it; that
+    can only cause false positives, never false negatives.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        """
+        Args:
+            capacity (int): Number of keys the filter is sized for
+            error_rate (float): False positive rate at capacity
+
+        Raises:
+            ValueError: If capacity or error_rate is out of range
+        """
+        if capacity < 1:
+            raise ValueError("Filter capacity must be positive")
+        if not 0 < error_rate < 1:
+            raise ValueError("Filter error rate must be between 0 and 1")
+        self.capacity = capacity
+        self.size = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hash_count = max(round(self.size / capacity * math.log(2)), 1)
+        self.count = 0
+        self._counters = bytearray(self.size)
+
+    def _positions(self, key):
+        """Derive the key's counter positions from two halves of one hash (double hashing)"""
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return [(first + index * second) % self.size for index in range(self.hash_count)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            if self._counters[position] < 255:
+                self._counters[position] += 1
+        self.count += 1
+
+    def discard(self, key):
+        """Remove a key that was added. Removing a key that wasn't added corrupts the filter."""
+        positions = self._positions(key)
+        if not all(self._counters[position] for position in positions):
+            return
+        for position in positions:
+            if self._counters[position] < 255:
+                self._counters[position] -= 1
+        self.count -= 1
+
+    def __contains__(self, key):
+        return all(self._counters[position] for position in self._positions(key))
+
+    def __len__(self):
+        return self.count
@@ -1,31 +1,303 @@
+import asyncio
+import concurrent.futures
 import json
 import logging
+import select
+import socket
+import zlib
+from collections import deque
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+IOV_MAX = 1024
+PROTOCOL_VERSION = 3
+STATUS_CODES = {"success": 0, "error": 1, "ready_for_input": 2, "handshake": 3, "close": 4}
+STATUS_NAMES = {code: status for status, code in STATUS_CODES.items()}
+# the top bit of the 4-byte length header marks a compressed frame body
+COMPRESSED_FLAG = 0x80000000
+LENGTH_MASK = 0x7FFFFFFF
+COMPRESSION_METHODS = ["zlib"]
+# largest frame body accepted from a peer unless configured otherwise
+MAX_FRAME_SIZE = 4 * 1024 * 1024
+
+
+class FrameTooLarge(ValueError):
+    """Raised when a peer announces a frame above the receiver's size limit"""
+
+
+class JsonCodec:
+    """Messages as JSON objects with named keys - understood by every peer"""
+    name = "json"
+
+    @staticmethod
+    def encode(msg):
+        return json.dumps(msg).encode("utf-8")
+
+    @staticmethod
+    def decode(data):
+        return json.loads(str(data, "utf-8"))
+
+
+class CompactJsonCodec:
+    """Messages as JSON arrays of [status code, message, data(, request id)] without whitespace"""
+    name = "json-compact"
+    encoder = json.JSONEncoder(separators=(",", ":"))
+
+    @staticmethod
+    def pack(msg):
+        fields = [STATUS_CODES[msg["status"]], msg["message"], msg["data"]]
+        if "id" in msg:
+            fields.append(msg["id"])
+        return fields
+
+    @staticmethod
+    def unpack(fields):
+        try:
+            status, message, data, *request_id = fields
+            msg = {"status": STATUS_NAMES[status], "message": message, "data": data}
+            if request_id:
+                msg["id"] = request_id[0]
+            return msg
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"Malformed compact message: {e}") from e
+
+    @classmethod
+    def encode(cls, msg):
+        return cls.encoder.encode(cls.pack(msg)).encode("utf-8")
+
+    @classmethod
+    def decode(cls, data):
+        return cls.unpack(json.loads(str(data, "utf-8")))
+
+
+class MsgpackCodec(CompactJsonCodec):
+    """Messages as MessagePack arrays of [status code, message, data(, request id)]; needs the msgpack package"""
+    name = "msgpack"
+
+    @classmethod
+    def encode(cls, msg):
+        return msgpack.packb(cls.pack(msg))
+
+    @classmethod
+    def decode(cls, data):
+        return cls.unpack(msgpack.unpackb(data))
+
+
+# codecs this peer can speak, in order of preference
+CODECS = {codec.name: codec for codec in (MsgpackCodec, CompactJsonCodec, JsonCodec)
+          if codec is not MsgpackCodec or msgpack is not None}
+# every codec can be told apart by the first byte of an encoded message
+CODEC_MARKERS = {ord("{"): JsonCodec, ord("["): CompactJsonCodec}
+if msgpack is not None:
+    CODEC_MARKERS.update({marker: MsgpackCodec for marker in range(0x90, 0xa0)})
 
 
 class CommunicationProtocol:
-    def __init__(self, sock, buffer_size=1024):
+    def __init__(self, sock, buffer_size=1024, max_buffer_size=1024 * 1024, compression_threshold=4096,
+                 compression_level=6, max_frame_size=MAX_FRAME_SIZE):
         self.sock = sock
         self.buffer_size = buffer_size
+        self.max_buffer_size = max_buffer_size
+        self.max_frame_size = max_frame_size
+        self.compression_threshold = compression_threshold
+        self.compression_level = compression_level
+        self._header = bytearray(4)
+        self._buffer = bytearray(buffer_size)
+        self._outgoing = []
+        self.codec = JsonCodec
+        self.compression = None
 
     @staticmethod
-    def format_message(message, status="success", data=None):
+    def format_message(message, status="success", data=None, request_id=None):
         """
         Creates a consistently formatted message dictionary for both success and error cases.
         Args:
             message: The main message content to be sent
-            status: Message status - "success", "error" or "ready for input" (default: "success")
+            status: Message status - "success", "error", "ready for input", "handshake" or "close"
+                (default: "success")
             data: Optional data payload (default: None)
+            request_id: Optional id of the request the message belongs to (default: None).
+                Clients number their requests and the server echoes the id on every response,
+                so several requests can be in flight at once.
 
         Returns:
             dict: A properly formatted message dictionary
         """
-        if status not in ["success", "error", "ready_for_input"]:
-            raise ValueError("Status must either be 'success', 'error' or 'ready for input'")
-        return {
+        if status not in STATUS_CODES:
+            raise ValueError("Status must either be 'success', 'error', 'ready for input', 'handshake' or 'close'")
+        msg = {
             "status": status,
             "message": message,
             "data": data if data is not None else ()
             }
+        if request_id is not None:
+            msg["id"] = request_id
+        return msg
+
+    def encode(self, msg):
+        """
+        Serialize a message into a length-prefixed frame.
+        Args:
+            msg: A pre-formatted dictionary or a plain message
+
+        Returns:
+            tuple: The 4-byte length header and the body encoded with the negotiated codec,
+            compressed if compression was negotiated and the body is above the threshold
+
+        Raises:
+            ValueError: If the message is too large for a single frame
+        """
+        if not isinstance(msg, dict):
+            msg = self.format_message(msg)
+        encoded_msg = self.codec.encode(msg)
+        header = len(encoded_msg)
+        if self.compression and header >= self.compression_threshold:
+            compressed_msg = zlib.compress(encoded_msg, self.compression_level)
+            if len(compressed_msg) < header:
+                encoded_msg = compressed_msg
+                header = len(compressed_msg) | COMPRESSED_FLAG
+        if header & LENGTH_MASK != len(encoded_msg):
+            raise ValueError(f"Message too large: {len(encoded_msg)} bytes")
+        return header.to_bytes(4, byteorder="big"), encoded_msg
+
+    @staticmethod
+    def decode(data):
+        """
+        Deserialize a frame body. The codec is recognized from the first byte, so frames
+        sent before and after a codec switch can be mixed freely.
+        Args:
+            data: The frame body without the length header (bytes-like)
+
+        Returns:
+            dict: The decoded message
+
+        Raises:
+            ValueError: If the body isn't encoded with a known codec
+        """
+        codec = CODEC_MARKERS.get(data[0]) if len(data) else None
+        if codec is None:
+            raise ValueError("Unknown message encoding")
+        return codec.decode(data)
+
+    def _decode_frame(self, header, body):
+        """
+        Decode a frame body, decompressing it first if its header is flagged.
+        Args:
+            header: The frame's 4-byte header as an integer
+            body: The frame body (bytes-like)
+
+        Raises:
+            ValueError: If the body can't be decompressed or decoded
+            FrameTooLarge: If the body decompresses to more than max_frame_size bytes
+        """
+        if header & COMPRESSED_FLAG:
+            decompressor = zlib.decompressobj()
+            try:
+                # inflating stops at the limit, so a small body can't expand into a huge one
+                body = decompressor.decompress(body, self.max_frame_size)
+            except zlib.error as e:
+                raise ValueError(f"Invalid compressed message: {e}") from e
+            if decompressor.unconsumed_tail:
+                raise FrameTooLarge(f"Compressed frame expands beyond the {self.max_frame_size} byte limit")
+        return self.decode(body)
+
+    def handshake_offer(self):
+        """
+        Build the handshake message the server sends right after its welcome message.
+
+        Returns:
+            dict: Handshake message listing the supported codecs and compression methods
+            in order of preference
+        """
+        return self.format_message("", status="handshake",
+                                   data={"version": PROTOCOL_VERSION, "codecs": list(CODECS),
+                                         "compression": COMPRESSION_METHODS})
+
+    @staticmethod
+    def handshake_answer(offer, session_token=None):
+        """
+        Pick the first codec and compression method from the server's offer that this
+        peer supports. Plain, uncompressed JSON is used if nothing matches.
+        Args:
+            offer: The handshake message received from the server
+            session_token (str, optional): Token of an earlier login to resume
+
+        Returns:
+            dict: Handshake message announcing the selection to the server
+        """
+        options = offer.get("data") or {}
+        name = next((codec for codec in options.get("codecs", []) if codec in CODECS), JsonCodec.name)
+        compression = next((method for method in options.get("compression", [])
+                            if method in COMPRESSION_METHODS), None)
+        data = {"version": PROTOCOL_VERSION, "codec": name, "compression": compression}
+        if session_token is not None:
+            data["token"] = session_token
+        return CommunicationProtocol.format_message("", status="handshake", data=data)
+
+    def answer_handshake(self, offer, session_token=None):
+        """
+        Answer the server's handshake offer and use the selected codec and compression
+        method for all further messages.
+        Args:
+            offer: The handshake message received from the server
+            session_token (str, optional): Token of an earlier login to resume
+
+        Returns:
+            str: Name of the selected codec
+        """
+        answer = self.handshake_answer(offer, session_token)
+        self.send(answer)
+        self.accept_handshake(answer)
+        return self.codec.name
+
+    def accept_handshake(self, answer):
+        """
+        Switch to the codec and compression method selected in a handshake answer.
+        Args:
+            answer: The handshake answer, as received from the client or sent to the server
+
+        Raises:
+            ValueError: If the client selected a codec or compression method that wasn't offered
+        """
+        options = answer.get("data") or {}
+        name = options.get("codec", JsonCodec.name)
+        compression = options.get("compression")
+        if name not in CODECS:
+            raise ValueError(f"Unsupported codec: {name}")
+        if compression is not None and compression not in COMPRESSION_METHODS:
+            raise ValueError(f"Unsupported compression method: {compression}")
+        self.codec = CODECS[name]
+        self.compression = compression
+        logging.info(f"Negotiated {name} codec, compression {compression}, protocol version {options.get('version')}")
+
+    def queue(self, msg):
+        """
+        Encode a message and hold it back until the next flush().
+        Args:
+            msg: A pre-formatted dictionary
+        Raises:
+            TypeError: If message cannot be encoded
+        """
+        self._outgoing.extend(self.encode(msg))
+
+    def flush(self):
+        """
+        Send all queued frames at once.
+        Raises:
+            ConnectionError: If sending fails
+        """
+        if not self._outgoing:
+            return
+        buffers, self._outgoing = self._outgoing, []
+        try:
+            self._write(buffers)
+        except ConnectionError as e:
+            logging.error(f"Failed to send message: {e}")
+            raise
 
     def send(self, msg):
         """
@@ -37,25 +309,74 @@ class CommunicationProtocol:
             ConnectionError: If sending fails
             TypeError: when message is not a dictionary
         """
-        if not isinstance(msg, dict):
-            msg = self.format_message(msg)
         try:
-            encoded_msg = json.dumps(msg).encode("utf-8")
-            message_len = len(encoded_msg).to_bytes(4, byteorder="big")
-            self.sock.sendall(message_len + encoded_msg)
+            self.queue(msg)
         except json.JSONDecodeError as e:
             logging.error(f"Invalid message format: {e}")
             raise
-        except ConnectionError as e:
-            logging.error(f"Failed to send message: {e}")
-            raise
+        self.flush()
+
+    def _write(self, buffers):
+        """
+        Write the buffers to the socket with as few vectored sendmsg calls as possible,
+        without joining them first. Falls back to a single sendall where sendmsg
+        is not available.
+        """
+        if not hasattr(self.sock, "sendmsg"):
+            self.sock.sendall(b"".join(buffers))
+            return
+        views = [memoryview(buffer) for buffer in buffers]
+        first = 0
+        while first < len(views):
+            try:
+                sent = self.sock.sendmsg(views[first:first + IOV_MAX])
+            except BlockingIOError:
+                select.select([], [self.sock], [])
+                continue
+            while sent:
+                if sent >= len(views[first]):
+                    sent -= len(views[first])
+                    first += 1
+                else:
+                    views[first] = views[first][sent:]
+                    sent = 0
+
+    def _recv_into(self, view):
+        """
+        Fill the whole view with data from the socket, however many reads it takes.
+
+        Raises:
+            BrokenPipeError: If peer closes connection before the view is filled
+        """
+        received = 0
+        while received < len(view):
+            try:
+                count = self.sock.recv_into(view[received:])
+            except BlockingIOError:
+                select.select([self.sock], [], [])
+                continue
+            if not count:
+                raise BrokenPipeError("Connection closed by peer")
+            received += count
+
+    def _frame_view(self, msg_len):
+        """
+        Return a view of the reusable receive buffer sized for a frame of msg_len bytes.
+        The buffer grows to the next power of two for larger frames and is released
+        again once it's above max_buffer_size and no longer needed.
+        """
+        if msg_len > len(self._buffer):
+            self._buffer = bytearray(1 << (msg_len - 1).bit_length())
+        elif len(self._buffer) > self.max_buffer_size and msg_len <= self.buffer_size:
+            self._buffer = bytearray(self.buffer_size)
+        return memoryview(self._buffer)[:msg_len]
 
     def receive(self):
         """
         Receives a complete message from the socket.
         The protocol expects:
-        1. A 4-byte header containing message length
-        2. The message body as JSON-encoded data
+        1. A 4-byte header containing message length, with the top bit set if the body is compressed
+        2. The message body as encoded data
 
         Returns:
             Message: The received message
@@ -67,20 +388,251 @@ class CommunicationProtocol:
             json.JSONDecodeError: If received data is not valid JSON
         """
         try:
-            header = self.sock.recv(4)
-            if not header:
-                raise BrokenPipeError("Connection closed by peer")
-            msg_len = int.from_bytes(header, byteorder="big")
-            if msg_len <= 0:
-                raise ValueError(f"Invalid message length: {msg_len}")
-            data = bytearray()
-            remaining = msg_len
-            while remaining > 0:
-                chunk = self.sock.recv(min(remaining, self.buffer_size))
-                data.extend(chunk)
-                remaining -= len(chunk)
-            message = json.loads(data.decode("utf-8"))
-            return message
+            return self._read_message()
         except (BrokenPipeError, ValueError, ConnectionError, json.JSONDecodeError) as e:
             logging.error(f"Error receiving message: {e}")
             raise
+
+    def _check_length(self, msg_len):
+        """
+        Check the body length announced by a frame header, before any buffer is sized for it.
+
+        Raises:
+            ValueError: If the length is zero
+            FrameTooLarge: If the length is above max_frame_size
+        """
+        if msg_len <= 0:
+            raise ValueError(f"Invalid message length: {msg_len}")
+        if msg_len > self.max_frame_size:
+            raise FrameTooLarge(f"Frame of {msg_len} bytes exceeds the {self.max_frame_size} byte limit")
+
+    def _read_message(self):
+        self._recv_into(memoryview(self._header))
+        header = int.from_bytes(self._header, byteorder="big")
+        msg_len = header & LENGTH_MASK
+        self._check_length(msg_len)
+        data = self._frame_view(msg_len)
+        self._recv_into(data)
+        return self._decode_frame(header, data)
+
+    def close_gracefully(self, timeout=5.0):
+        """
+        Close the connection with a close/ack exchange: flush queued frames, send a close
+        frame and shut down the sending side, then wait until the peer acknowledges or
+        hangs up before closing the socket. Frames still arriving are discarded.
+        Args:
+            timeout (float): Seconds to wait for the peer's acknowledgement
+        """
+        if self.sock.fileno() == -1:
+            return
+        try:
+            self.queue(self.format_message("", status="close"))
+            self.flush()
+            self.sock.shutdown(socket.SHUT_WR)
+            self.sock.settimeout(timeout)
+            while self._read_message().get("status") != "close":
+                pass
+        except (OSError, ValueError) as e:
+            logging.debug(f"Connection closed without acknowledgement: {e}")
+        finally:
+            self.sock.close()
+
+    def acknowledge_close(self):
+        """Answer the peer's close frame once all queued frames are sent, then close the socket"""
+        if self.sock.fileno() == -1:
+            return
+        try:
+            self.queue(self.format_message("", status="close"))
+            self.flush()
+            self.sock.shutdown(socket.SHUT_WR)
+        except OSError as e:
+            logging.debug(f"Failed to acknowledge close: {e}")
+        finally:
+            self.sock.close()
+
+    def close(self):
+        """Flush queued frames, then shut down and close the underlying socket"""
+        if self.sock.fileno() == -1:
+            return
+        try:
+            self.flush()
+        except OSError as e:
+            logging.error(f"Failed to flush pending messages: {e}")
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        finally:
+            self.sock.close()
+
+
+class AsyncCommunicationProtocol(CommunicationProtocol):
+    """
+    Protocol bound to asyncio streams instead of a blocking socket.
+
+    Frames are read on the event loop by read_frame() and buffered until they are
+    picked up. send(), flush(), receive() and close() keep the blocking interface
+    of CommunicationProtocol and are meant to be called from worker threads. Code
+    running on the event loop uses the *_async coroutines instead; the only blocking
+    call it may make is flush(), which then hands the frames to the transport
+    without waiting for them to drain.
+
+    receive() waits at most input_timeout seconds for the client's next message, so
+    a worker thread can't be held indefinitely by a client that stops sending.
+    """
+
+    def __init__(self, reader, writer, loop=None, input_timeout=None, **kwargs):
+        super().__init__(writer.get_extra_info("socket"), **kwargs)
+        self.reader = reader
+        self.writer = writer
+        self.loop = loop if loop is not None else asyncio.get_running_loop()
+        self.input_timeout = input_timeout
+        self._frames = deque()
+
+    @classmethod
+    async def open_connection(cls, host, port, **kwargs):
+        """Connect to a server and return a protocol bound to the new connection"""
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer, **kwargs)
+
+    async def read_frame(self):
+        """
+        Read one complete frame from the stream and buffer it for receive().
+
+        Returns:
+            bool: True if a frame was buffered, False if the connection was closed
+
+        Raises:
+            FrameTooLarge: If the frame is above max_frame_size
+        """
+        try:
+            header = int.from_bytes(await self.reader.readexactly(4), byteorder="big")
+            if header & LENGTH_MASK:
+                self._check_length(header & LENGTH_MASK)
+            self._frames.append((header, await self.reader.readexactly(header & LENGTH_MASK)))
+            return True
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            self._frames.append(e)
+            return False
+
+    async def _write_async(self, buffers):
+        self.writer.writelines(buffers)
+        await self.writer.drain()
+
+    def _on_loop(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def _write(self, buffers):
+        if self._on_loop():
+            self.writer.writelines(buffers)
+            return
+        asyncio.run_coroutine_threadsafe(self._write_async(buffers), self.loop).result()
+
+    async def flush_async(self):
+        """Send all queued frames from the event loop"""
+        if not self._outgoing:
+            return
+        buffers, self._outgoing = self._outgoing, []
+        await self._write_async(buffers)
+
+    async def send_async(self, msg):
+        """Send a message from the event loop"""
+        self.queue(msg)
+        await self.flush_async()
+
+    def _next_message(self):
+        frame = self._frames.popleft()
+        if isinstance(frame, asyncio.IncompleteReadError):
+            raise BrokenPipeError("Connection closed by peer")
+        if isinstance(frame, Exception):
+            raise frame
+        header, body = frame
+        if not body:
+            raise ValueError("Invalid message length: 0")
+        return self._decode_frame(header, body)
+
+    def receive(self):
+        """
+        Return the next buffered message, waiting for the event loop to read one if needed.
+
+        Raises:
+            BrokenPipeError: If peer closes connection
+            ConnectionError: If connection is lost during transfer
+            ValueError: If message format is invalid
+            TimeoutError: If no message arrives within input_timeout seconds
+        """
+        try:
+            if not self._frames:
+                future = asyncio.run_coroutine_threadsafe(self.read_frame(), self.loop)
+                try:
+                    future.result(self.input_timeout)
+                except concurrent.futures.TimeoutError:
+                    future.cancel()
+                    raise TimeoutError(f"No message received within {self.input_timeout} seconds")
+            return self._next_message()
+        except (BrokenPipeError, ValueError, ConnectionError, TimeoutError) as e:
+            logging.error(f"Error receiving message: {e}")
+            raise
+
+    async def receive_async(self):
+        """Receive the next message from the event loop"""
+        if not self._frames:
+            await self.read_frame()
+        return self._next_message()
+
+    async def _close_async(self, buffers, timeout):
+        try:
+            self.writer.writelines(buffers)
+            await self.writer.drain()
+            if self.writer.can_write_eof():
+                self.writer.write_eof()
+            if timeout is not None:
+                await asyncio.wait_for(self._read_until_close(), timeout)
+        except (OSError, ValueError, asyncio.TimeoutError) as e:
+            logging.debug(f"Connection closed without acknowledgement: {e}")
+        finally:
+            self.writer.close()
+
+    async def _read_until_close(self):
+        while await self.read_frame():
+            header, body = self._frames.pop()
+            if body and self._decode_frame(header, body).get("status") == "close":
+                return
+
+    def close_gracefully(self, timeout=5.0):
+        """
+        Close the connection with a close/ack exchange: flush queued frames, send a close
+        frame and write EOF, then wait until the peer acknowledges or hangs up.
+        Args:
+            timeout (float): Seconds to wait for the peer's acknowledgement
+        """
+        asyncio.run_coroutine_threadsafe(self.close_gracefully_async(timeout), self.loop).result()
+
+    def acknowledge_close(self):
+        """Answer the peer's close frame once all queued frames are sent, then close the stream"""
+        asyncio.run_coroutine_threadsafe(self.acknowledge_close_async(), self.loop).result()
+
+    async def close_gracefully_async(self, timeout=5.0):
+        """Close the connection with a close/ack exchange from the event loop"""
+        if self.writer.is_closing():
+            return
+        self.queue(self.format_message("", status="close"))
+        buffers, self._outgoing = self._outgoing, []
+        await self._close_async(buffers, timeout)
+
+    async def acknowledge_close_async(self):
+        """Answer the peer's close frame from the event loop"""
+        if self.writer.is_closing():
+            return
+        self.queue(self.format_message("", status="close"))
+        buffers, self._outgoing = self._outgoing, []
+        await self._close_async(buffers, None)
+
+    def close(self):
+        """Flush queued frames and close the stream writer"""
+        try:
+            self.flush()
+        except OSError as e:
+            logging.error(f"Failed to flush pending messages: {e}")
+        self.loop.call_soon_threadsafe(self.writer.close)
@@ -1,72 +1,108 @@
-import json
 import logging
 import os
+import time
+from storage import STORAGE_BACKENDS, FieldIndex, ShardedStorage, VersionConflict
 
 
 class DbManager:
     db_file = "users.json"
+    storage = None
+    # ended sessions, keyed by session id, next to the user records so every process sees them
+    sessions = None
+    # seconds between purges of expired entries from the sessions table
+    sessions_purge_interval = 60
+    _sessions_purged = 0
 
     @classmethod
-    def _read_data(cls):
+    def configure(cls, backend="json", path=None, shards=1, **options):
         """
-        Helper method to read data from the database.
+        Select the storage backend used for all records.
+
+        Args:
+            backend (str): Name of the backend in STORAGE_BACKENDS ("json", "log", "mmap" or "sqlite")
+            path (str, optional): Database file, or directory of shard files when sharded.
+                Defaults to the backend's own default
+            shards (int): Number of shards to hash-partition the records across
+            **options: Backend specific options
 
         Returns:
-            dict: Database contents or empty dict if file doesn't exist
+            The configured storage backend
 
         Raises:
-            PermissionError: If file exists but can't be accessed
-            ValueError: If database file is corrupted
+            ValueError: If the backend is unknown
         """
-        try:
-            with open(cls.db_file, "r", encoding="utf-8") as db:
-                return json.load(db)
-        except FileNotFoundError:
-            return {}
-        except json.JSONDecodeError as e:
-            logging.error(f"Corrupted database file: {e}")
-            raise ValueError(f"Database file is corrupted: {e}") from e
-        except PermissionError as e:
-            logging.error(f"Permission denied accessing database: {e}")
-            raise
-        except OSError as e:
-            logging.error(f"OS error accessing database: {e}")
-            raise
+        if backend not in STORAGE_BACKENDS:
+            raise ValueError(f"Unknown storage backend: {backend}")
+        if path is not None:
+            options["path"] = path
+        if cls.storage is not None:
+            cls.storage.close()
+            cls.sessions.close()
+        storage_class = STORAGE_BACKENDS[backend]
+        if shards > 1:
+            cls.storage = ShardedStorage(storage_class, shards=shards, **options)
+            sessions_path = os.path.join(cls.storage.path, f"sessions{storage_class.extension}")
+        else:
+            cls.storage = storage_class(**options)
+            root, extension = os.path.splitext(cls.storage.path)
+            sessions_path = f"{root}.sessions{extension}"
+        session_options = {name: value for name, value in options.items() if name not in ("path", "log_path")}
+        cls.sessions = storage_class(path=sessions_path, **session_options)
+        return cls.storage
 
     @classmethod
-    def _write_data(cls, data):
+    def _storage(cls):
+        """Return the configured backend, falling back to the JSON file at db_file"""
+        if cls.storage is None:
+            cls.configure(path=cls.db_file)
+        return cls.storage
+
+    @classmethod
+    def save(cls, key, value, expected_version=None):
         """
-        Helper method to write data to the database.
+        Save or update a record in the database. Every save increments the record's
+        version; passing the version last read makes the save a compare-and-set.
 
         Args:
-            data (dict): Data to write to database
+            key (str): Record key (username)
+            value (dict): User data to save
+            expected_version (int, optional): Version the record must be at for the save
+                to go ahead, 0 for a record that must not exist yet
+
+        Returns:
+            int: The record's new version
 
         Raises:
-            PermissionError: If file can't be written to
-            TypeError: If data is not JSON serializable
-            OSError: If file system error occurs
+            ValueError: If key or value is invalid
+            VersionConflict: If the record isn't at expected_version
+            TypeError: If value is not JSON serializable
         """
+        if not isinstance(key, str) or not key.strip():
+            raise ValueError("Invalid key: must be a non-empty string")
+        if not isinstance(value, dict):
+            raise ValueError("Invalid value: must be a dictionary")
         try:
-            with open(cls.db_file, "w", encoding="utf-8") as db:
-                json.dump(data, db, indent=4)
-        except TypeError as e:
-            logging.error(f"Invalid data format for JSON serialization: {e}")
-            raise TypeError(f"Data is not JSON serializable: {e}") from e
-        except PermissionError as e:
-            logging.error(f"Permission denied writing to database: {e}")
+            return cls._storage().save(key, value, expected_version)
+        except VersionConflict as e:
+            logging.info(f"Conditional save of {key} rejected: {e}")
+            raise
+        except (ValueError, TypeError, OSError) as e:
+            logging.error(f"Failed to save data for key {key}: {e}")
             raise
-        except OSError as e:
-            logging.error(f"OS error writing to database: {e}")
 
     @classmethod
-    def save(cls, key, value):
+    def insert_if_absent(cls, key, value):
         """
-        Save or update a record in the database.
+        Save a record only if no record with its key exists. The check and the write
+        are a single storage operation, so concurrent inserts of a key can't both succeed.
 
         Args:
             key (str): Record key (username)
             value (dict): User data to save
 
+        Returns:
+            bool: True if the record was inserted, False if the key already had a record
+
         Raises:
             ValueError: If key or value is invalid
             TypeError: If value is not JSON serializable
@@ -76,34 +112,66 @@ class DbManager:
         if not isinstance(value, dict):
             raise ValueError("Invalid value: must be a dictionary")
         try:
-            data = cls._read_data()
-            data[key] = value
-            cls._write_data(data)
+            cls._storage().save(key, value, expected_version=0)
+            return True
+        except VersionConflict:
+            return False
         except (ValueError, TypeError, OSError) as e:
             logging.error(f"Failed to save data for key {key}: {e}")
             raise
 
     @classmethod
-    def delete(cls, key):
+    def save_many(cls, records, expected_version=None):
         """
-        Delete a record from the database.
+        Save or update several records in a single write.
 
         Args:
-            key (str): Key to delete
+            records (dict): User data to save keyed by username
+            expected_version (int, optional): Version each record must be at to be saved,
+                0 to only insert records whose key is free. Other records are skipped.
+                The check is made within the write, against the latest stored records
 
         Returns:
-            dict: Status message
+            list: The keys of the records that were saved
+
+        Raises:
+            ValueError: If a key or value is invalid
+            TypeError: If a value is not JSON serializable
+        """
+        if not isinstance(records, dict):
+            raise ValueError("Invalid records: must be a dictionary")
+        for key, value in records.items():
+            if not isinstance(key, str) or not key.strip():
+                raise ValueError("Invalid key: must be a non-empty string")
+            if not isinstance(value, dict):
+                raise ValueError(f"Invalid value for {key}: must be a dictionary")
+        if not records:
+            return []
+        try:
+            return cls._storage().save_many(records, expected_version)
+        except (ValueError, TypeError, OSError) as e:
+            logging.error(f"Failed to save {len(records)} records: {e}")
+            raise
+
+    @classmethod
+    def delete(cls, key, expected_version=None):
+        """
+        Delete a record from the database.
+
+        Args:
+            key (str): Key to delete
+            expected_version (int, optional): Version the record must be at for the delete to go ahead
 
         Raises:
             KeyError: If key doesn't exist
+            VersionConflict: If the record isn't at expected_version
             OSError: If file system error occurs
         """
         try:
-            data = cls._read_data()
-            if key not in data:
-                raise KeyError(f"No record found for {key}")
-            del data[key]
-            cls._write_data(data)
+            cls._storage().delete(key, expected_version)
+        except VersionConflict as e:
+            logging.info(f"Conditional delete of {key} rejected: {e}")
+            raise
         except KeyError as e:
             logging.error(f"Delete failed - key not found: {e}")
             raise
@@ -111,10 +179,57 @@ class DbManager:
             logging.error(f"Failed to delete record: {e}")
             raise
 
+    @classmethod
+    def delete_if_present(cls, key):
+        """
+        Delete a record if it exists, checking for it within the delete itself.
+
+        Args:
+            key (str): Key to delete
+
+        Returns:
+            bool: True if the record was deleted, False if there was none
+
+        Raises:
+            OSError: If file system error occurs
+        """
+        try:
+            cls._storage().delete(key)
+            return True
+        except KeyError:
+            return False
+        except OSError as e:
+            logging.error(f"Failed to delete record: {e}")
+            raise
+
+    @classmethod
+    def delete_many(cls, keys):
+        """
+        Delete several records in a single write. Keys without a record are skipped.
+
+        Args:
+            keys (iterable): Keys to delete
+
+        Returns:
+            list: The keys that were deleted
+
+        Raises:
+            OSError: If file system error occurs
+        """
+        keys = list(keys)
+        if not keys:
+            return []
+        try:
+            return cls._storage().delete_many(keys)
+        except OSError as e:
+            logging.error(f"Failed to delete {len(keys)} records: {e}")
+            raise
+
     @classmethod
     def get(cls, key=None):
         """
-        Retrieve all data or a specific record by key.
+        Retrieve all data or a specific record by key. Records are served from the
+        backend's in-memory table and returned as copies.
 
         Args:
             key (str, optional): Specific key to retrieve
@@ -127,17 +242,186 @@ class DbManager:
             KeyError: If the key doesn't exist
         """
         try:
-            data = cls._read_data()
             if key is None:
-                return data
+                return cls._storage().get_all()
             if not isinstance(key, str):
                 raise ValueError("Key must be a string")
-            if key not in data:
-                raise KeyError(f"No record found for {key}")
-            return {key: data.get(key)}
+            return {key: cls._storage().get(key)}
         except ValueError as e:
             logging.error(f"Invalid key type: {e}")
             raise
         except OSError as e:
             logging.error(f"Failed to retrieve data: {e}")
             raise
+
+    @classmethod
+    def keys(cls):
+        """
+        Retrieve the keys of all records, without reading the records themselves.
+
+        Returns:
+            list: Record keys, in no particular order
+        """
+        try:
+            return cls._storage().keys()
+        except OSError as e:
+            logging.error(f"Failed to retrieve data: {e}")
+            raise
+
+    @classmethod
+    def stamp(cls):
+        """
+        Identify the current state of the database. The stamp changes whenever any
+        process changes a record, so data derived from the records stays valid for as
+        long as the stamp it was built under is current.
+
+        Returns:
+            A hashable value to compare with the stamp of a later call
+        """
+        return cls._storage().stamp()
+
+    @classmethod
+    def advance_stamp(cls, stamp):
+        """
+        Follow a stamp through the changes this process committed since it was taken.
+        If nobody else changed the database in between, the result is the current
+        stamp, so data derived from the records and updated for this process's own
+        changes stays valid.
+
+        Args:
+            stamp: Stamp returned by an earlier call to stamp
+
+        Returns:
+            The stamp the database had after the last of those changes, or stamp itself
+        """
+        return cls._storage().advance_stamp(stamp)
+
+    @classmethod
+    def revoke_session(cls, session_id, expires):
+        """
+        Record that a session was ended, so no process sharing the database resumes it
+        again. Entries are purged once the session would have expired anyway.
+
+        Args:
+            session_id (str): Id of the ended session
+            expires (int): Time the session's token expires, in seconds since the epoch
+
+        Raises:
+            OSError: If the database operation fails
+        """
+        cls._storage()
+        try:
+            cls.sessions.save(session_id, {"expires": expires})
+            now = time.time()
+            if now - cls._sessions_purged >= cls.sessions_purge_interval:
+                cls._sessions_purged = now
+                expired = [key for key, record in cls.sessions.get_all().items() if record["expires"] <= now]
+                cls.sessions.delete_many(expired)
+        except OSError as e:
+            logging.error(f"Failed to record the end of session {session_id}: {e}")
+            raise
+
+    @classmethod
+    def session_revoked(cls, session_id):
+        """
+        Check whether a session was ended by any process sharing the database.
+
+        Args:
+            session_id (str): Session id
+
+        Returns:
+            bool: True if the session was ended
+
+        Raises:
+            OSError: If database access fails
+        """
+        cls._storage()
+        try:
+            cls.sessions.get(session_id)
+            return True
+        except KeyError:
+            return False
+        except OSError as e:
+            logging.error(f"Failed to retrieve data: {e}")
+            raise
+
+    @classmethod
+    def get_version(cls, key):
+        """
+        Retrieve the current version of a record, for a later conditional save or delete.
+
+        Args:
+            key (str): Record key
+
+        Returns:
+            int: The record's version, 0 if it doesn't exist
+
+        Raises:
+            ValueError: If key is invalid
+        """
+        if not isinstance(key, str):
+            raise ValueError("Key must be a string")
+        try:
+            return cls._storage().get_version(key)
+        except OSError as e:
+            logging.error(f"Failed to retrieve data: {e}")
+            raise
+
+    @classmethod
+    def scan(cls, after=None, limit=100):
+        """
+        Retrieve a page of records in key order.
+
+        Args:
+            after (str, optional): Return only records with keys after this one
+            limit (int): Maximum number of records to return
+
+        Returns:
+            dict: Up to limit records, in ascending key order
+
+        Raises:
+            ValueError: If after or limit is invalid
+        """
+        if after is not None and not isinstance(after, str):
+            raise ValueError("Key must be a string")
+        if not isinstance(limit, int) or limit < 1:
+            raise ValueError("Limit must be a positive integer")
+        try:
+            return dict(cls._storage().scan(after, limit))
+        except OSError as e:
+            logging.error(f"Failed to retrieve data: {e}")
+            raise
+
+    @classmethod
+    def find(cls, field, value=None, prefix=None, filters=None, limit=None):
+        """
+        Retrieve the records matching a query on an indexed field, in no particular
+        order. Only matching records are visited.
+
+        Args:
+            field (str): Indexed field to search, one of FieldIndex.fields
+            value (str, optional): Value the field must equal
+            prefix (str, optional): Prefix the field must start with, if no value is given
+            filters (dict, optional): Other indexed fields and the values they must equal
+            limit (int, optional): Maximum number of records to return
+
+        Returns:
+            dict: Matching records keyed by record key
+
+        Raises:
+            ValueError: If the query is invalid
+        """
+        filters = filters or {}
+        if field not in FieldIndex.fields or not set(filters) <= set(FieldIndex.fields):
+            raise ValueError(f"Only {', '.join(FieldIndex.fields)} can be queried")
+        if (value is None) == (prefix is None):
+            raise ValueError("Either a value or a prefix is required")
+        if not all(isinstance(item, str) for item in (value or prefix, *filters.values())):
+            raise ValueError("Query values must be strings")
+        if limit is not None and (not isinstance(limit, int) or limit < 1):
+            raise ValueError("Limit must be a positive integer")
+        try:
+            return dict(cls._storage().find(field, value, prefix, filters, limit))
+        except OSError as e:
+            logging.error(f"Failed to query data: {e}")
+            raise
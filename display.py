@@ -16,18 +16,20 @@ class Display:
                         print(f"{key}: {value}")
                     print()
                 elif display_type == "tabular" and data_content:
-                    Display.display_tables(message)
+                    Display.display_tables(data_content)
+                    print()
+                elif display_type == "rows" and data_content:
+                    Display.display_tables(data_content, header=False)
+                    print()
+                elif display_type == "page" and data_content:
+                    Display.display_tables(data_content["users"])
                     print()
             except (ValueError, TypeError):
                 logging.error(f"Error displaying message data")
                 print(f"Error displaying message")
 
     @staticmethod
-    def display_tables(message):
-        if not message or not message.get("data"):
-            print("No data to display")
-            return
-        data = message["data"][0]
+    def display_tables(data, header=True):
         if not data:
             print("No records found.")
             return
@@ -39,4 +41,5 @@ class Display:
             table.add_row(record)
         table.max_width = 30
         table.hrules = True
+        table.header = header
         print(table)
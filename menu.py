@@ -1,5 +1,4 @@
 import logging
-from time import sleep
 from utilities import load_menu_config, format_server_info, calculate_uptime, get_user_input
 
 
@@ -11,8 +10,11 @@ class Menu:
     and available commands based on the user's role and login status.
     """
 
-    def __init__(self, server):
-        self.server = server
+    default_page_size = 50
+    max_page_size = 1000
+
+    def __init__(self, session):
+        self.session = session
         self.current_commands = {}
 
         self.logged_out_commands = {
@@ -42,19 +44,37 @@ class Menu:
         self.user_management_commands = {
             "add": self._handle_registration,
             "delete": self._handle_user_deletion,
+            "delete -p": self._handle_bulk_deletion,
+            "import": self._handle_bulk_import,
             "user info": self._handle_user_info,
             "user info -a": self._handle_all_users_info,
+            "user info -p": self._handle_users_page,
+            "filter": self._handle_user_filter,
             "help": self._handle_help,
             "back": self._handle_return
         }
 
+    @property
+    def state(self):
+        """Name of the current menu, to return a resumed session to it"""
+        if self.current_commands.keys() == self.user_management_commands.keys():
+            return "user management"
+        return "main"
+
+    def restore_state(self, state):
+        """Show the menu named by state, as returned by the state property"""
+        if state == "user management" and self.session.user and self.session.user.role == "admin":
+            self._enter_user_management_menu()
+        else:
+            self.update_menu_state()
+
     def update_menu_state(self):
         """Update menu commands based on current user state (logged in, logged out)"""
         if self.current_commands.keys() == self.user_management_commands.keys():
             self._enter_user_management_menu()
-        elif not self.server.user:
+        elif not self.session.user:
             self._set_logged_out_state()
-        elif self.server.user.role == "admin":
+        elif self.session.user.role == "admin":
             self._set_admin_state()
         else:
             self._set_user_state()
@@ -62,22 +82,22 @@ class Menu:
     def _set_logged_out_state(self):
         """Configure menu for logged-out users"""
         self.current_commands = load_menu_config("menu", "logged_out", "user")
-        self.server.send("Please log in or register", (self.current_commands, "list"), prompt=True)
+        self.session.send("Please log in or register", (self.current_commands, "list"), prompt=True)
 
     def _set_admin_state(self):
         """Configure menu for admins"""
         self.current_commands = load_menu_config("menu", "logged_in", "admin")
-        self.server.send("Administrator Main Menu", (self.current_commands, "list"), prompt=True)
+        self.session.send("Administrator Main Menu", (self.current_commands, "list"), prompt=True)
 
     def _set_user_state(self):
         """Configure menu for regular users"""
         self.current_commands = load_menu_config("menu", "logged_in", "user")
-        self.server.send("User Main Menu", (self.current_commands, "list"), prompt=True)
+        self.session.send("User Main Menu", (self.current_commands, "list"), prompt=True)
 
     def _enter_user_management_menu(self):
         """Switch to user management menu state"""
         self.current_commands = load_menu_config("manage_users_menu", "logged_in", "admin")
-        self.server.send("User management menu", (self.current_commands, "list"))
+        self.session.send("User management menu", (self.current_commands, "list"))
 
     def _is_valid_command(self, command):
         if command in self.current_commands:
@@ -88,107 +108,142 @@ class Menu:
         """Get appropriate handler for current menu state"""
         if self.current_commands.keys() == self.user_management_commands.keys():
             return self.user_management_commands[command]
-        if not self.server.user:
+        if not self.session.user:
             return self.logged_out_commands[command]
-        elif self.server.user.role == "admin":
+        elif self.session.user.role == "admin":
             return self.admin_commands[command]
         else:
             return self.user_commands[command]
 
     def handle_command(self, command):
         """
-        Execute command based on the current menu state
+        Execute command based on the current menu state. Messages sent by the handler
+        are coalesced and written together, e.g. a result followed by the next menu.
         Returns True if command executed successfully, False otherwise
           """
         command = command.casefold()
         if not self._is_valid_command(command):
-            logging.error(f"Bad request received from {self.server.address}")
-            self.server.send("Unknown request. Choose correct command!", (self.current_commands, "list"), "error")
-            return True
-        try:
-            handler = self._get_command_handler(command)
-            should_continue = handler()
-            return should_continue if isinstance(should_continue, bool) else True
-        except Exception as e:
-            logging.error(f"Error executing command '{command}': {e}")
-            self.server.send("An error occurred. Please try again.", status="error")
+            logging.error(f"Bad request received from {self.session.address}")
+            self.session.send("Unknown request. Choose correct command!", (self.current_commands, "list"), "error")
             return True
+        with self.session.batch():
+            try:
+                handler = self._get_command_handler(command)
+                should_continue = handler()
+                return should_continue if isinstance(should_continue, bool) else True
+            except Exception as e:
+                logging.error(f"Error executing command '{command}': {e}")
+                self.session.send("An error occurred. Please try again.", status="error")
+                return True
 
     def _handle_login(self):
-        self.server.process_login()
+        self.session.process_login()
         self.update_menu_state()
 
     def _handle_registration(self):
         """Handle new account registration"""
         required_fields = []
-        if self.server.user is None:
+        if self.session.user is None:
             required_fields = ["username", "password", "email"]
-        elif self.server.user.role == "admin":
+        elif self.session.user.role == "admin":
             required_fields = ["username", "password", "email", "role"]
-        self.server.process_registration(required_fields)
+        self.session.process_registration(required_fields)
         self.update_menu_state()
 
     def _handle_logout(self):
-        self.server.process_logout()
+        self.session.process_logout()
         self.update_menu_state()
 
     def _handle_user_info(self):
-        if self.server.user.role == "user":
-            self.server.get_user_data(self.server.user.username)
+        if self.session.user.role == "user":
+            self.session.get_user_data(self.session.user.username)
         else:
-            self.server.send("Enter username: ")
-            username = self.server.receive()["message"]
-            self.server.get_user_data(username)
+            self.session.send("Enter username: ")
+            username = self.session.receive()["message"]
+            self.session.get_user_data(username)
 
     def _handle_all_users_info(self):
-        self.server.get_all_users()
+        self.session.get_all_users()
+
+    def _handle_users_page(self):
+        """Handle display of a single page of users"""
+        fields = get_user_input(self.session, ["page size", "cursor"])
+        try:
+            page_size = int(fields["page size"] or self.default_page_size)
+        except ValueError:
+            page_size = 0
+        if not 1 <= page_size <= self.max_page_size:
+            self.session.send(f"Page size must be between 1 and {self.max_page_size}!", status="error")
+            return
+        self.session.get_users_page(page_size, fields["cursor"] or None)
+
+    def _handle_user_filter(self):
+        """Handle listing of users filtered by role and/or email prefix"""
+        fields = get_user_input(self.session, ["role", "email prefix", "limit"])
+        try:
+            limit = int(fields["limit"] or self.default_page_size)
+        except ValueError:
+            limit = 0
+        if not 1 <= limit <= self.max_page_size:
+            self.session.send(f"Limit must be between 1 and {self.max_page_size}!", status="error")
+            return
+        self.session.get_filtered_users(fields["role"] or None, fields["email prefix"] or None, limit)
 
     def _handle_client_exit(self):
         """Handle client exit request"""
         try:
-            self.server.send("Preparing to close connection...", prompt=False)
-            sleep(0.5)
-            self.server.send("Goodbye!", prompt=False)
-            sleep(0.5)
-            self.server.cleanup()
+            self.session.send("Preparing to close connection...", prompt=False)
+            self.session.send("Goodbye!", prompt=False)
+            self.session.close()
             return False
         except Exception as e:
             logging.error(f"Error during client shutdown: {e}")
             # try:
-            #     self.server.cleanup()
+            #     self.session.cleanup()
             # except Exception:
             #     pass
             return False
 
     def _handle_inbox(self):
-        pass
+        self.session.show_inbox()
 
     def _handle_server_info(self):
         """Handle server version and build date display"""
-        self.server.send(format_server_info(self.server.version, self.server.build_date))
+        self.session.send(format_server_info(self.session.server.version, self.session.server.build_date))
 
     def _handle_uptime_display(self):
-        self.server.send(f"Server uptime:{calculate_uptime(self.server.start_time)} (hh:mm:ss)")
+        self.session.send(f"Server uptime:{calculate_uptime(self.session.server.start_time)} (hh:mm:ss)")
 
     def _handle_users_management(self):
         """Switch to user management menu"""
         self.current_commands = load_menu_config("manage_users_menu", "logged_in", "admin")
-        self.server.send("User management menu", (self.current_commands, "list"))
+        self.session.remember_menu()
+        self.session.send("User management menu", (self.current_commands, "list"))
 
     def _handle_user_deletion(self):
         """Handle user account deletion"""
-        username = get_user_input(self.server, ["username"])["username"]
-        self.server.process_account_deletion(username)
+        username = get_user_input(self.session, ["username"])["username"]
+        self.session.process_account_deletion(username)
+
+    def _handle_bulk_deletion(self):
+        """Handle deletion of all accounts matching a pattern"""
+        pattern = get_user_input(self.session, ["pattern"])["pattern"]
+        self.session.process_bulk_deletion(pattern)
+
+    def _handle_bulk_import(self):
+        """Handle import of accounts from a file"""
+        self.session.process_bulk_import()
 
     def _handle_return(self):
         """Return to the main Admin menu"""
         self._set_admin_state()
+        self.session.remember_menu()
 
     def _handle_server_shutdown(self):
         print("Shutting down...")
-        sleep(2)
-        self.server.connection.close()
-        exit()
+        self.session.close()
+        self.session.server.shutdown()
+        return False
 
     def _handle_help(self):
-        self.server.send("Available Commands", (self.current_commands, "list"))
+        self.session.send("Available Commands", (self.current_commands, "list"))
@@ -0,0 +1,235 @@
+import base64
+import hashlib
+import hmac
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+
+class HasherBusy(BlockingIOError):
+    """Raised when too many passwords are already waiting to be hashed or verified"""
+
+
+class PasswordHasher:
+    """
+    Salted, deliberately slow password hashing with scrypt or PBKDF2.
+
+    Hashes are stored as "algorithm$cost parameters$salt$digest", so every record
+    carries the algorithm and cost it was hashed with and the defaults can be raised
+    without invalidating existing passwords; needs_rehash tells when a stored hash
+    should be replaced. Bare hex digests written before salting was introduced are
+    recognized as unsalted SHA-256.
+
+    Hashing and verification run on a bounded pool of worker processes, so they
+    neither hold the GIL in the server process nor run on the thread serving a
+    request. At most max_pending of them may be queued or running at once; beyond
+    that, callers get HasherBusy straight away instead of waiting behind the queue.
+    """
+
+    algorithms = ("scrypt", "pbkdf2_sha256")
+    algorithm = "scrypt"
+    scrypt_n = 2 ** 14
+    scrypt_r = 8
+    scrypt_p = 1
+    pbkdf2_iterations = 600000
+    salt_size = 16
+    workers = None
+    max_pending = 64
+    _pool = None
+    _slots = threading.BoundedSemaphore(max_pending)
+    _pool_lock = threading.Lock()
+
+    @classmethod
+    def configure(cls, algorithm="scrypt", workers=None, max_pending=64, scrypt_n=2 ** 14, scrypt_r=8, scrypt_p=1,
+                  pbkdf2_iterations=600000):
+        """
+        Select the algorithm and cost used for new hashes, and size the worker pool.
+
+        Args:
+            algorithm (str): "scrypt" or "pbkdf2_sha256"
+            workers (int, optional): Worker processes, defaults to the number of CPUs.
+                0 hashes on the calling thread
+            max_pending (int): Maximum number of hashes queued or running at once
+            scrypt_n (int): scrypt CPU/memory cost, a power of 2
+            scrypt_r (int): scrypt block size
+            scrypt_p (int): scrypt parallelization
+            pbkdf2_iterations (int): PBKDF2-HMAC-SHA256 iterations
+
+        Raises:
+            ValueError: If the algorithm is unknown or a parameter is out of range
+        """
+        if algorithm not in cls.algorithms:
+            raise ValueError(f"Unknown password hashing algorithm: {algorithm}")
+        if scrypt_n < 2 or scrypt_n & (scrypt_n - 1):
+            raise ValueError("scrypt cost must be a power of 2")
+        if min(scrypt_r, scrypt_p, pbkdf2_iterations, max_pending) < 1 or (workers is not None and workers < 0):
+            raise ValueError("Hashing parameters must be positive")
+        cls.shutdown()
+        cls.algorithm = algorithm
+        cls.workers = workers
+        cls.max_pending = max_pending
+        cls._slots = threading.BoundedSemaphore(max_pending)
+        cls.scrypt_n, cls.scrypt_r, cls.scrypt_p = scrypt_n, scrypt_r, scrypt_p
+        cls.pbkdf2_iterations = pbkdf2_iterations
+
+    @classmethod
+    def _parameters(cls):
+        """Return the cost parameters of the configured algorithm"""
+        if cls.algorithm == "scrypt":
+            return cls.scrypt_n, cls.scrypt_r, cls.scrypt_p
+        return cls.pbkdf2_iterations,
+
+    @staticmethod
+    def _derive(algorithm, parameters, password, salt):
+        if algorithm == "scrypt":
+            n, r, p = parameters
+            return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r + 1024 * 1024,
+                                  dklen=32)
+        iterations, = parameters
+        return hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+
+    @staticmethod
+    def _encode(algorithm, parameters, salt, digest):
+        encoded = [base64.b64encode(part).decode("ascii") for part in (salt, digest)]
+        return "$".join([algorithm, *(str(parameter) for parameter in parameters), *encoded])
+
+    @staticmethod
+    def _decode(password_hash):
+        """
+        Split a stored hash into its algorithm, cost parameters, salt and digest.
+
+        Raises:
+            ValueError: If the hash isn't in a known format
+        """
+        if "$" not in password_hash:
+            if len(password_hash) != 64:
+                raise ValueError("Unknown password hash format")
+            return "sha256", (), b"", bytes.fromhex(password_hash)
+        algorithm, *parameters, salt, digest = password_hash.split("$")
+        if algorithm not in PasswordHasher.algorithms or len(parameters) != (3 if algorithm == "scrypt" else 1):
+            raise ValueError(f"Unknown password hash format: {algorithm}")
+        try:
+            return (algorithm, tuple(int(parameter) for parameter in parameters), base64.b64decode(salt),
+                    base64.b64decode(digest))
+        except ValueError as e:
+            raise ValueError(f"Corrupted password hash: {e}") from e
+
+    @staticmethod
+    def _hash(password, algorithm, parameters, salt_size):
+        """Hash a password with a new salt. Runs in a worker process."""
+        salt = os.urandom(salt_size)
+        digest = PasswordHasher._derive(algorithm, parameters, password, salt)
+        return PasswordHasher._encode(algorithm, parameters, salt, digest)
+
+    @staticmethod
+    def _verify(password, password_hash):
+        """Check a password against a stored hash. Runs in a worker process."""
+        algorithm, parameters, salt, digest = PasswordHasher._decode(password_hash)
+        if algorithm == "sha256":
+            candidate = hashlib.sha256(password.encode()).digest()
+        else:
+            candidate = PasswordHasher._derive(algorithm, parameters, password, salt)
+        return hmac.compare_digest(candidate, digest)
+
+    @classmethod
+    def _executor(cls):
+        with cls._pool_lock:
+            if cls._pool is None:
+                cls._pool = ProcessPoolExecutor(max_workers=cls.workers,
+                                                mp_context=multiprocessing.get_context("spawn"))
+            return cls._pool
+
+    @classmethod
+    def _run(cls, function, *args):
+        """
+        Run function on the worker pool and wait for its result.
+
+        Raises:
+            HasherBusy: If max_pending hashes are already queued or running
+            OSError: If the worker pool has failed
+        """
+        if cls.workers == 0:
+            return function(*args)
+        slots = cls._slots
+        if not slots.acquire(blocking=False):
+            logging.warning("Password hashing queue is full - rejecting request")
+            raise HasherBusy("Too many password hashing requests, try again later")
+        try:
+            return cls._executor().submit(function, *args).result()
+        except BrokenProcessPool as e:
+            logging.error(f"Password hashing worker pool failed: {e}")
+            with cls._pool_lock:
+                cls._pool = None
+            raise OSError("Password hashing failed") from e
+        finally:
+            slots.release()
+
+    @classmethod
+    def hash(cls, password):
+        """
+        Hash a password with a new random salt, using the configured algorithm and cost.
+
+        Returns:
+            str: The encoded hash to store
+
+        Raises:
+            HasherBusy: If the hashing queue is full
+        """
+        return cls._run(cls._hash, password, cls.algorithm, cls._parameters(), cls.salt_size)
+
+    @classmethod
+    def hash_many(cls, passwords, workers=None):
+        """
+        Hash many passwords on a dedicated pool of processes, outside the request
+        pool and its queue limit.
+
+        Args:
+            passwords (list): Passwords to hash
+            workers (int, optional): Number of processes, defaults to the number of CPUs.
+                1 hashes on the calling thread
+
+        Returns:
+            list: Encoded hashes in the order of the input
+        """
+        hash_password = partial(cls._hash, algorithm=cls.algorithm, parameters=cls._parameters(),
+                                salt_size=cls.salt_size)
+        if workers == 1:
+            return [hash_password(password) for password in passwords]
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            chunk_size = max(len(passwords) // ((workers or multiprocessing.cpu_count()) * 4), 1)
+            return list(pool.map(hash_password, passwords, chunksize=chunk_size))
+
+    @classmethod
+    def verify(cls, password, password_hash):
+        """
+        Check a password against a stored hash of any supported algorithm, in constant time.
+
+        Returns:
+            bool: True if the password matches
+
+        Raises:
+            ValueError: If the stored hash isn't in a known format
+            HasherBusy: If the hashing queue is full
+        """
+        algorithm, *_ = cls._decode(password_hash)
+        if algorithm == "sha256":
+            return cls._verify(password, password_hash)
+        return cls._run(cls._verify, password, password_hash)
+
+    @classmethod
+    def needs_rehash(cls, password_hash):
+        """Whether a stored hash uses another algorithm or cost than new hashes would"""
+        algorithm, parameters, *_ = cls._decode(password_hash)
+        return algorithm != cls.algorithm or parameters != cls._parameters()
+
+    @classmethod
+    def shutdown(cls):
+        """Stop the worker processes. They are started again on the next use."""
+        with cls._pool_lock:
+            pool, cls._pool = cls._pool, None
+        if pool is not None:
+            pool.shutdown()
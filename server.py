@@ -1,52 +1,60 @@
+import argparse
+import asyncio
 import logging
+import os
+import queue
+import selectors
 import socket
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from logging.handlers import RotatingFileHandler
-from time import sleep
-from communication import CommunicationProtocol
-from menu import Menu
-from user_model import User
-from utilities import get_user_input
+from communication import MAX_FRAME_SIZE, CommunicationProtocol, AsyncCommunicationProtocol
+from db_manager import DbManager
+from password_hasher import PasswordHasher
+from session import Session
+from session_tokens import SessionTokens
+from supervisor import Supervisor
+from user_dao import UserDAO
 
 
 class Server:
-    def __init__(self, port, server_sock=None):
+    def __init__(self, port, server_sock=None, reuse_port=False, compression_threshold=4096, input_timeout=30.0,
+                 max_frame_size=MAX_FRAME_SIZE):
         self.host = "127.0.0.1"
         self.port = port
         self.buffer = 1024
+        self.compression_threshold = compression_threshold
+        self.input_timeout = input_timeout
+        self.max_frame_size = max_frame_size
         try:
             if server_sock is None:
                 self.server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                if reuse_port:
+                    self.server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             else:
                 self.server_sock = server_sock
         except socket.error as e:
             logging.error(f"Failed to create server socket: {e}")
             raise
-        self.connection = None
-        self.address = None
-        self.com_protocol = None
         self.version = "1.1.0"
         self.build_date = "2023-12-03"
         self.start_time = datetime.now()
-        self.user = None
-        self.menu = Menu(self)
+        self.is_running = True
+        self._loop = None
+        self._executor = None
+        self._async_server = None
+        self._wakeup_sock = None
         logging.basicConfig(handlers=[RotatingFileHandler('server.log', maxBytes=5 * 1024 * 1024, backupCount=5)],
                             level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
     def start_server(self):
         """
-        Start the server and handle a single client connection.
+        Bind the server socket and start listening for client connections.
         """
         try:
             self.server_sock.bind((self.host, self.port))
             self.server_sock.listen()
             print(f"Listening on {self.host}:{self.port}")
-            self.connection, self.address = self.server_sock.accept()
-            logging.info(f"Accepted connection from {self.address[0]}:{self.address[1]}")
-            print(f"Accepted connection from {self.address[0]}:{self.address[1]}")
-            self.com_protocol = CommunicationProtocol(self.connection)
-            welcome_message = f"Connected to server at {self.host}"
-            self.send(welcome_message, prompt=False)
         except OSError as e:
             logging.error(f"Server failed to start: {e}")
             raise
@@ -54,201 +62,271 @@ class Server:
             logging.error(f"An error occurred during server startup: {e}")
             raise
 
-    def run_main_menu(self):
-        """Initialize and display main menu"""
-        self.menu.update_menu_state()
+    def accept_session(self):
+        """
+        Accept a single client connection and create a session for it.
+        """
+        connection, address = self.server_sock.accept()
+        print(f"Accepted connection from {address[0]}:{address[1]}")
+        com_protocol = CommunicationProtocol(connection, compression_threshold=self.compression_threshold,
+                                             max_frame_size=self.max_frame_size)
+        return Session(self, com_protocol, address)
+
+    def shutdown(self):
+        """Stop accepting new connections and stop serving"""
+        self.is_running = False
+        if self._async_server is not None:
+            self._loop.call_soon_threadsafe(self._async_server.close)
+        if self._wakeup_sock is not None:
+            self._wakeup_sock.send(b"\0")
 
     def cleanup(self):
-        """Cleans up resources after connection has been closed"""
-        if self.connection:
-            try:
-                self.connection.shutdown(socket.SHUT_RDWR)
-                self.connection.close()
-            except Exception as e:
-                logging.error(f"Error closing client connection: {e}")
+        """Cleans up resources after the server has stopped"""
         if self.server_sock:
             try:
                 self.server_sock.close()
             except Exception as e:
                 logging.error(f"Error closing server socket: {e}")
 
-    def send(self, message, data=None, status="success", prompt=True):
+    def run(self):
+        """Serve a single client connection at a time"""
+        try:
+            self.start_server()
+            while self.is_running:
+                self.accept_session().run()
+        finally:
+            self.cleanup()
+            logging.info("Server shutdown complete")
+
+    async def _serve_connection(self, reader, writer):
         """
-            Send messages with proper formatting and error handling.
-            Handles business logic for message formatting and error responses.
+        Serve a single client connection on the event loop. The greeting is written and
+        the connection is read between requests on the loop, so idle clients don't hold
+        a thread. Each request is then handled by the session on the bounded worker pool,
+        so blocking handlers don't stall other clients. A handler waiting for further
+        input from its client gives up after input_timeout seconds, so stalled clients
+        can't keep the workers from serving everybody else.
         """
+        com_protocol = AsyncCommunicationProtocol(reader, writer, self._loop,
+                                                  compression_threshold=self.compression_threshold,
+                                                  input_timeout=self.input_timeout, max_frame_size=self.max_frame_size)
+        session = Session(self, com_protocol, writer.get_extra_info("peername"))
         try:
-            if not message and not data:
-                return
-            message_to_send = self.com_protocol.format_message(message, data=data, status=status)
-            self.com_protocol.send(message_to_send)
-
-            if prompt:
-                ready_signal = self.com_protocol.format_message("", status="ready_for_input")
-                self.com_protocol.send(ready_signal)
-
-        except ConnectionError as e:
-            logging.error(f"Connection lost: {e}")
-            raise
+            session.open()
+            await writer.drain()
+            while True:
+                await com_protocol.read_frame()
+                if not await self._loop.run_in_executor(self._executor, session.serve_next):
+                    break
         except Exception as e:
-            logging.error(f"Invalid message format: {e}")
-            error_message = self.com_protocol.format_message(str(e), status="error")
-            self.com_protocol.send(error_message)
+            logging.error(f"Session {session.address} terminated with an error: {e}")
+        finally:
+            writer.close()
 
-    def receive(self):
+    async def serve_async(self, workers=8):
         """
-        Receive and process a message from a client.
+        Serve any number of concurrent client connections from a single event loop.
+
+        Args:
+            workers (int): Number of worker threads handling requests
         """
+        self._loop = asyncio.get_running_loop()
+        self.start_server()
+        self._async_server = await asyncio.start_server(self._serve_connection, sock=self.server_sock)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="session")
         try:
-            message = self.com_protocol.receive()
-            return message
-
-        except BrokenPipeError as e:
-            logging.error(f"Client {self.address} has closed the connection")
-            self.connection.close()
-            raise ConnectionError("Client disconnected") from e
-
-        except ConnectionResetError as e:
-            logging.error(f"Connection to client {self.address} was forcefully closed")
-            self.connection.close()
-            raise ConnectionError("Client connection lost") from e
-
-        except ValueError as e:
-            logging.error(f"Received invalid message from client {self.address}: {e}")
-            self.send("Invalid message format", status="error")
-            raise RuntimeError(f"Invalid message received from client: {e}") from e
-
-    def process_registration(self, required_fields):
-        """Process new user registration"""
-        user_data = get_user_input(self, required_fields)
-        try:
-            if not self.user:
-                if User.register(username=user_data["username"], password=user_data["password"],
-                                 email=user_data["email"]):
-                    self.send(f"User {user_data['username']} added successfully!", prompt=False)
-            elif self.user.role == "admin":
-                if User.register(username=user_data["username"], password=user_data["password"],
-                                 email=user_data["email"], role=user_data["role"]):
-                    self.send(f"User {user_data['username']} added successfully!", prompt=False)
-        except ValueError as e:
-            self.send(f"Registration failed: {e}", status="error")
-            logging.info(f"New user signup failed for username: {user_data['username']}: {e}")
-        except TypeError as e:
-            self.send(f"Invalid input format!", status="error")
-            logging.info(f"New user signup failed for username: {user_data['username']}: {e}")
-        except OSError as e:
-            self.send(f"Registration failed. Please try again later!", status="error")
-            logging.info(f"New user signup failed for username {user_data['username']} due to the following error: {e}")
+            async with self._async_server:
+                try:
+                    await self._async_server.serve_forever()
+                except asyncio.CancelledError:
+                    pass
+        finally:
+            # handlers still waiting for input give up on their own once the loop stops answering
+            self._executor.shutdown(wait=False, cancel_futures=True)
 
-    def process_account_deletion(self, username):
-        """Process user account removal"""
+    def run_async(self, workers=8):
+        """Run the asyncio multi-client server until shutdown"""
         try:
-            self.send(f"Are you sure you want to delete user {username}? Y/N")
-            if self.receive()["message"].upper() == "Y":
-                if User.delete(username):
-                    self.send(f"User {username} deleted successfully!")
-            else:
-                self.send("Operation has been cancelled!")
-            return
-
-        except KeyError:
-            self.send(f"Operation failed - user not found!", status="error")
-            logging.info(f"Account removal failed - user {username} not found")
-        except ValueError as e:
-            self.send(f"Operation failed - invalid username format!", status="error")
-            logging.info(f"Account deletion failed - invalid input: {e}")
-        except OSError as e:
-            self.send(f"Operation failed! Please try again later", status="error")
-            logging.info(f"Account removal failed due to the following error: {e}")
+            asyncio.run(self.serve_async(workers))
+        finally:
+            self.cleanup()
+            logging.info("Server shutdown complete")
 
-    def process_login(self):
-        """Process user login"""
-        while True:
-            try:
-                user_credentials = get_user_input(self, ["username", "password"])
-                self.user = User.log_in(user_credentials["username"], user_credentials["password"])
-                break
-            except (KeyError, ValueError) as e:
-                logging.info(f"Login failed: {e}")
-                self.send("Incorrect username or password!", status="error", prompt=False)
-            except (TypeError, AttributeError) as e:
-                logging.error(f"Login failed due to system error: {e}")
-                self.send("Incorrect input!", status="error", prompt=False)
-
-    def process_logout(self):
-        self.user = None
-        self.send("You have been successfully logged out!", prompt=False)
-        sleep(0.1)
-
-    def get_user_data(self, username=None):
-        """Retrieve single user information"""
+    def _reject_connection(self, connection, address):
+        """Tell a client that the server is saturated and close its connection"""
+        logging.warning(f"Rejected connection from {address[0]}:{address[1]} - worker pool saturated")
+        com_protocol = CommunicationProtocol(connection)
         try:
-            user_data = User.get(username)
-            self.send("", (user_data, "tabular"))
-        except KeyError as e:
-            self.send(f"User {username} not found!", status="error")
-            logging.info(f"Failed to retrieve user data - user not found: {e}")
-        except ValueError as e:
-            self.send(f"Invalid username format!", status="error")
-            logging.info(f"Failed to retrieve user data - invalid data format: {e}")
+            com_protocol.send(com_protocol.format_message("Server is busy. Please try again later.", status="error"))
         except OSError as e:
-            self.send(f"Operation failed! Please try again later", status="error")
-            logging.info(f"Failed to retrieve user data due to the following error: {e}")
+            logging.error(f"Failed to notify rejected client {address}: {e}")
+        finally:
+            com_protocol.close()
 
-    def get_all_users(self):
-        """Retrieve and display data for all users"""
+    def _run_session_task(self, session, task, finished):
+        """
+        Run a single session task on a worker thread and hand the session back to the
+        accepting thread once it's done.
+        """
         try:
-            user_data = User.get()
-            if user_data:
-                self.send("All Users:", (user_data, "tabular"))
-            else:
-                self.send("No users found in the system.")
+            keep_open = task() is not False
         except Exception as e:
-            logging.error(f"Failed to retrieve user data: {e}")
-            self.send("Failed to retrieve user data", status="error")
+            logging.error(f"Session {session.address} terminated with an error: {e}")
+            keep_open = False
+        finished.put((session, keep_open))
+        self._wakeup_sock.send(b"\0")
 
-    def run(self):
+    def run_threaded(self, workers=8, max_pending=32):
+        """
+        Serve concurrent clients with a bounded pool of worker threads.
+
+        Connections are accepted on the calling thread, which also watches idle sessions
+        with a selector, so a session only occupies a worker while one of its requests is
+        being handled. When all workers are busy, up to max_pending further sessions are
+        queued; connections arriving beyond that are rejected. A handler waiting for
+        further input from its client gives up after input_timeout seconds, so stalled
+        clients can't keep the workers from serving everybody else.
+
+        Args:
+            workers (int): Number of worker threads handling requests
+            max_pending (int): Number of sessions that may wait for a free worker
+        """
+        selector = selectors.DefaultSelector()
+        finished = queue.SimpleQueue()
+        wakeup_recv, self._wakeup_sock = socket.socketpair()
+        in_progress = 0
         try:
             self.start_server()
-            self.run_main_menu()
-            while True:
-                try:
-                    client_msg = self.receive()["message"]
-                    if not client_msg:
-                        logging.info("Client closed connection")
-                        break
-                    if not self.menu.handle_command(client_msg):
-                        logging.info("Client requested shutdown - closing connection")
-                        break
-                except ConnectionError as e:
-                    print(f"Connection has been lost: {e}")
-                    break
-                except RuntimeError as e:
-                    logging.error(f"Error processing message from {self.address}: {e}")
-                    try:
-                        self.send("An error occurred processing your request. Please try again.", status="error")
-                        if not self.user or not self.user.is_logged_in:
-                            self.menu.update_menu_state()
-                    except ConnectionError:
-                        logging.error(f"Failed to send error message to client {self.address}")
-                        break
-                except Exception as e:
-                    logging.error(f"Unexpected error: {e}")
-                    try:
-                        if self.connection and self.connection.fileno() != -1:
-                            self.send("An error occurred. Please try again.", status="error")
-                    except (ConnectionError, OSError) as e:
-                        logging.error(f"Failed to send error message - connection lost: {e}")
-                        break
-                    except Exception as e:
-                        logging.error(f"Failed to send error message - unexpected error: {e}")
-                        break
-
+            selector.register(self.server_sock, selectors.EVENT_READ)
+            selector.register(wakeup_recv, selectors.EVENT_READ)
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="session") as executor:
+                while self.is_running:
+                    for key, _ in selector.select():
+                        if key.fileobj is self.server_sock:
+                            connection, address = self.server_sock.accept()
+                            if in_progress >= workers + max_pending:
+                                self._reject_connection(connection, address)
+                                continue
+                            # a handler waiting for further input gives up instead of holding its worker
+                            connection.settimeout(self.input_timeout)
+                            com_protocol = CommunicationProtocol(connection,
+                                                                 compression_threshold=self.compression_threshold,
+                                                                 max_frame_size=self.max_frame_size)
+                            session = Session(self, com_protocol, address)
+                            in_progress += 1
+                            executor.submit(self._run_session_task, session, session.open, finished)
+                        elif key.fileobj is wakeup_recv:
+                            wakeup_recv.recv(4096)
+                            while not finished.empty():
+                                session, keep_open = finished.get()
+                                in_progress -= 1
+                                if keep_open and self.is_running:
+                                    selector.register(session.com_protocol.sock, selectors.EVENT_READ, session)
+                                else:
+                                    session.cleanup()
+                        else:
+                            session = key.data
+                            selector.unregister(key.fileobj)
+                            in_progress += 1
+                            executor.submit(self._run_session_task, session, session.serve_next, finished)
+                for key in list(selector.get_map().values()):
+                    if key.data is not None:
+                        key.data.cleanup()
         finally:
+            selector.close()
+            wakeup_recv.close()
+            self._wakeup_sock.close()
+            self._wakeup_sock = None
             self.cleanup()
             logging.info("Server shutdown complete")
 
+    def serve(self, mode="asyncio", threads=8, max_pending=32):
+        """
+        Serve clients until shutdown using the selected concurrency mode.
+
+        Args:
+            mode (str): "asyncio", "threaded" or "blocking"
+            threads (int): Worker threads handling requests in asyncio and threaded mode
+            max_pending (int): Sessions that may wait for a free worker in threaded mode
+        """
+        if mode == "asyncio":
+            self.run_async(workers=threads)
+        elif mode == "threaded":
+            self.run_threaded(workers=threads, max_pending=max_pending)
+        elif mode == "blocking":
+            self.run()
+        else:
+            raise ValueError(f"Unknown server mode: {mode}")
+
+
+def run_worker(port, mode, threads, max_pending, compression_threshold, input_timeout, max_frame_size, storage_config,
+               hasher_config, session_config):
+    """Entry point of a worker process sharing the server port with its siblings"""
+    DbManager.configure(**storage_config)
+    UserDAO.build_username_filter()
+    PasswordHasher.configure(**hasher_config)
+    SessionTokens.configure(**session_config)
+    server = Server(port, reuse_port=True, compression_threshold=compression_threshold, input_timeout=input_timeout,
+                    max_frame_size=max_frame_size)
+    server.serve(mode, threads=threads, max_pending=max_pending)
+
 
 if __name__ == "__main__":
-    server = Server(55555)
-    server.run()
+    parser = argparse.ArgumentParser(description="Client-Server-App server")
+    parser.add_argument("--port", type=int, default=55555)
+    parser.add_argument("--mode", choices=["asyncio", "threaded", "blocking"], default="asyncio",
+                        help="serve clients concurrently on an event loop, on a pool of worker threads, "
+                             "or one at a time")
+    parser.add_argument("--threads", type=int, default=8, help="worker threads handling requests in asyncio and "
+                                                                "threaded mode")
+    parser.add_argument("--max-pending", type=int, default=32,
+                        help="sessions that may wait for a free worker thread before new connections are rejected")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes sharing the port via SO_REUSEPORT, restarted by a supervisor on crash")
+    parser.add_argument("--compression-threshold", type=int, default=4096,
+                        help="compress frames of at least this many bytes for clients that support it")
+    parser.add_argument("--input-timeout", type=float, default=30.0,
+                        help="seconds a request waits for the client to send a further field before the "
+                             "connection is dropped (asyncio and threaded mode)")
+    parser.add_argument("--max-frame-size", type=int, default=MAX_FRAME_SIZE,
+                        help="largest frame, also after decompression, accepted from a client; clients sending "
+                             "a larger one are disconnected")
+    parser.add_argument("--storage", choices=["json", "log", "mmap", "sqlite"], default="json",
+                        help="store users in a single JSON file, in an append-only log compacted into a JSON or "
+                             "memory-mapped snapshot, or in a SQLite database")
+    parser.add_argument("--db-file", help="user database file, or directory when sharded (default: users.json, "
+                                          "users.snap for mmap, users.db for sqlite, users/ when sharded)")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="hash-partition users across this many database files")
+    parser.add_argument("--kdf", choices=["scrypt", "pbkdf2_sha256"], default="scrypt",
+                        help="password hashing algorithm for new hashes; older hashes are upgraded on login")
+    parser.add_argument("--scrypt-n", type=int, default=2 ** 14, help="scrypt cost, a power of 2")
+    parser.add_argument("--pbkdf2-iterations", type=int, default=600000, help="PBKDF2 iterations")
+    parser.add_argument("--kdf-workers", type=int,
+                        help="processes hashing passwords (default: number of CPUs, 0 to hash on the session thread)")
+    parser.add_argument("--kdf-max-pending", type=int, default=64,
+                        help="password hashes that may be queued or running before logins are turned away as busy")
+    parser.add_argument("--session-ttl", type=int, default=3600,
+                        help="seconds a session token can resume a login on a new connection; tokens are signed "
+                             "with $SESSION_TOKEN_SECRET, or a random key that only lasts until the server exits")
+    args = parser.parse_args()
+    storage_config = {"backend": args.storage, "path": args.db_file, "shards": args.shards}
+    hasher_config = {"algorithm": args.kdf, "workers": args.kdf_workers, "max_pending": args.kdf_max_pending,
+                     "scrypt_n": args.scrypt_n, "pbkdf2_iterations": args.pbkdf2_iterations}
+    # one key for all workers, so a session resumes whichever worker the new connection lands on
+    secret = os.environ.get("SESSION_TOKEN_SECRET")
+    session_config = {"secret": secret.encode() if secret else os.urandom(32), "ttl": args.session_ttl}
+    if args.workers > 1:
+        supervisor = Supervisor(run_worker, args=(args.port, args.mode, args.threads, args.max_pending,
+                                                  args.compression_threshold, args.input_timeout,
+                                                  args.max_frame_size, storage_config, hasher_config, session_config),
+                                workers=args.workers)
+        supervisor.run()
+    else:
+        DbManager.configure(**storage_config)
+        UserDAO.build_username_filter()
+        PasswordHasher.configure(**hasher_config)
+        SessionTokens.configure(**session_config)
+        server = Server(args.port, compression_threshold=args.compression_threshold, input_timeout=args.input_timeout,
+                        max_frame_size=args.max_frame_size)
+        server.serve(args.mode, threads=args.threads, max_pending=args.max_pending)
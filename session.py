@@ -0,0 +1,414 @@
+import logging
+from contextlib import contextmanager
+from communication import FrameTooLarge
+from menu import Menu
+from session_tokens import SessionTokens
+from user_model import User
+from utilities import get_user_input
+
+
+class Session:
+    """
+    State and request handling for a single client connection. Every connection
+    gets its own session, so the logged-in user, menu state and communication
+    protocol are never shared between clients.
+    """
+
+    def __init__(self, server, com_protocol, address):
+        self.server = server
+        self.com_protocol = com_protocol
+        self.address = address
+        self.user = None
+        self.menu = Menu(self)
+        self.request_id = None
+        self._batch_depth = 0
+
+    def open(self):
+        """Greet the client, offer the available codecs and display the main menu"""
+        logging.info(f"Accepted connection from {self.address[0]}:{self.address[1]}")
+        welcome_message = f"Connected to server at {self.server.host}"
+        with self.batch():
+            self.send(welcome_message, prompt=False)
+            self.com_protocol.queue(self.com_protocol.handshake_offer())
+            self.run_main_menu()
+
+    def run_main_menu(self):
+        """Initialize and display main menu"""
+        self.menu.update_menu_state()
+
+    def cleanup(self):
+        """Cleans up resources after connection has been closed"""
+        try:
+            self.com_protocol.close()
+        except Exception as e:
+            logging.error(f"Error closing client connection: {e}")
+
+    def close(self):
+        """Close the connection once all pending messages have been delivered to the client"""
+        try:
+            self.com_protocol.close_gracefully()
+        except Exception as e:
+            logging.error(f"Error closing client connection: {e}")
+
+    @contextmanager
+    def batch(self):
+        """
+        Hold back messages sent within the block and write them to the client together
+        once it exits, or earlier if the session needs to wait for client input.
+        """
+        self._batch_depth += 1
+        try:
+            yield
+        finally:
+            self._batch_depth -= 1
+        if not self._batch_depth:
+            self.com_protocol.flush()
+
+    def send(self, message, data=None, status="success", prompt=True):
+        """
+            Send messages with proper formatting and error handling.
+            Handles business logic for message formatting and error responses.
+            The message and its ready_for_input signal go out in a single write, both
+            tagged with the id of the request being answered.
+        """
+        try:
+            if not message and not data:
+                return
+            message_to_send = self.com_protocol.format_message(message, data=data, status=status,
+                                                               request_id=self.request_id)
+            self.com_protocol.queue(message_to_send)
+
+            if prompt:
+                ready_signal = self.com_protocol.format_message("", status="ready_for_input",
+                                                                request_id=self.request_id)
+                self.com_protocol.queue(ready_signal)
+
+            if not self._batch_depth:
+                self.com_protocol.flush()
+
+        except ConnectionError as e:
+            logging.error(f"Connection lost: {e}")
+            raise
+        except Exception as e:
+            logging.error(f"Invalid message format: {e}")
+            error_message = self.com_protocol.format_message(str(e), status="error", request_id=self.request_id)
+            self.com_protocol.send(error_message)
+
+    def receive(self):
+        """
+        Receive and process a message from a client. Clients may send requests ahead
+        without waiting for ready_for_input; they are read here one at a time, in order.
+        """
+        try:
+            self.com_protocol.flush()
+            message = self.com_protocol.receive()
+            self.request_id = message.get("id")
+            return message
+
+        except BrokenPipeError as e:
+            logging.error(f"Client {self.address} has closed the connection")
+            self.cleanup()
+            raise ConnectionError("Client disconnected") from e
+        except TimeoutError as e:
+            logging.warning(f"Client {self.address} stopped responding: {e}")
+            self.cleanup()
+            raise ConnectionError("Client timed out") from e
+
+        except ConnectionResetError as e:
+            logging.error(f"Connection to client {self.address} was forcefully closed")
+            self.cleanup()
+            raise ConnectionError("Client connection lost") from e
+
+        except FrameTooLarge as e:
+            # the body was never read, so the stream can't be resynchronized
+            logging.error(f"Client {self.address} sent an oversized frame: {e}")
+            self.cleanup()
+            raise ConnectionError("Frame too large") from e
+
+        except ValueError as e:
+            logging.error(f"Received invalid message from client {self.address}: {e}")
+            self.send("Invalid message format", status="error")
+            raise RuntimeError(f"Invalid message received from client: {e}") from e
+
+    def process_registration(self, required_fields):
+        """Process new user registration"""
+        user_data = get_user_input(self, required_fields)
+        try:
+            if not self.user:
+                if User.register(username=user_data["username"], password=user_data["password"],
+                                 email=user_data["email"]):
+                    self.send(f"User {user_data['username']} added successfully!", prompt=False)
+            elif self.user.role == "admin":
+                if User.register(username=user_data["username"], password=user_data["password"],
+                                 email=user_data["email"], role=user_data["role"]):
+                    self.send(f"User {user_data['username']} added successfully!", prompt=False)
+        except ValueError as e:
+            self.send(f"Registration failed: {e}", status="error")
+            logging.info(f"New user signup failed for username: {user_data['username']}: {e}")
+        except TypeError as e:
+            self.send(f"Invalid input format!", status="error")
+            logging.info(f"New user signup failed for username: {user_data['username']}: {e}")
+        except OSError as e:
+            self.send(f"Registration failed. Please try again later!", status="error")
+            logging.info(f"New user signup failed for username {user_data['username']} due to the following error: {e}")
+
+    def process_account_deletion(self, username):
+        """Process user account removal"""
+        try:
+            self.send(f"Are you sure you want to delete user {username}? Y/N", ({"count": 1}, "confirm"))
+            if self.receive()["message"].upper() == "Y":
+                if User.delete(username):
+                    self.send(f"User {username} deleted successfully!")
+            else:
+                self.send("Operation has been cancelled!")
+            return
+
+        except KeyError:
+            self.send(f"Operation failed - user not found!", status="error")
+            logging.info(f"Account removal failed - user {username} not found")
+        except ValueError as e:
+            self.send(f"Operation failed - invalid username format!", status="error")
+            logging.info(f"Account deletion failed - invalid input: {e}")
+        except OSError as e:
+            self.send(f"Operation failed! Please try again later", status="error")
+            logging.info(f"Account removal failed due to the following error: {e}")
+
+    def process_bulk_import(self):
+        """Import users from a JSONL or CSV file on the server"""
+        path = get_user_input(self, ["file path"])["file path"]
+        try:
+            summary = User.import_users(path)
+        except FileNotFoundError:
+            self.send(f"File {path} not found!", status="error")
+            return
+        except ValueError as e:
+            self.send(f"Import failed: {e}", status="error")
+            logging.info(f"User import from {path} failed: {e}")
+            return
+        except OSError as e:
+            self.send("Import failed. Please try again later!", status="error")
+            logging.info(f"User import from {path} failed due to the following error: {e}")
+            return
+        report = [f"Imported {summary['imported']} users, skipped {summary['skipped']} existing or duplicate users, "
+                  f"{summary['invalid']} invalid rows", *summary["errors"]]
+        self.send("\n".join(report))
+
+    def process_bulk_deletion(self, pattern):
+        """Remove all accounts matching a pattern, except the administrator's own"""
+        try:
+            usernames = [username for username in User.find(pattern) if username != self.user.username]
+            if not usernames:
+                self.send(f"No users match {pattern}")
+                return
+            self.send(f"Are you sure you want to delete {len(usernames)} users matching {pattern}? Y/N",
+                      ({"count": len(usernames)}, "confirm"))
+            if self.receive()["message"].upper() == "Y":
+                deleted = User.delete_many(usernames)
+                self.send(f"{len(deleted)} users deleted successfully!")
+            else:
+                self.send("Operation has been cancelled!")
+        except OSError as e:
+            self.send("Operation failed! Please try again later", status="error")
+            logging.info(f"Bulk account removal failed due to the following error: {e}")
+
+    def process_login(self):
+        """Process user login"""
+        while True:
+            try:
+                user_credentials = get_user_input(self, ["username", "password"])
+                self.user = User.log_in(user_credentials["username"], user_credentials["password"])
+                self.send("", ({"username": self.user.username, "token": self.user.session_token}, "session"),
+                          prompt=False)
+                break
+            except (KeyError, ValueError) as e:
+                logging.info(f"Login failed: {e}")
+                self.send("Incorrect username or password!", status="error", prompt=False)
+            except (TypeError, AttributeError) as e:
+                logging.error(f"Login failed due to system error: {e}")
+                self.send("Incorrect input!", status="error", prompt=False)
+            except ConnectionError:
+                raise
+            except OSError as e:
+                logging.error(f"Login failed: {e}")
+                self.send("Server is busy. Please try again later!", status="error", prompt=False)
+
+    def process_logout(self):
+        try:
+            self.user.log_out()
+        except OSError as e:
+            logging.error(f"Logout of {self.user.username} failed: {e}")
+            self.send("Logout failed! Please try again later", status="error", prompt=False)
+            return
+        self.user = None
+        self.send("You have been successfully logged out!", prompt=False)
+
+    def show_inbox(self):
+        """Send the user's messages. The mailbox is read for this command only and not kept afterwards."""
+        inbox = self.user.inbox
+        try:
+            messages = inbox.messages()
+        except (KeyError, OSError) as e:
+            logging.error(f"Failed to read the inbox of {self.user.username}: {e}")
+            self.send("Failed to read your inbox!", status="error")
+            return
+        finally:
+            inbox.release()
+        if messages:
+            self.send(f"You have {len(messages)} messages:", (messages, "tabular"))
+        else:
+            self.send("Your inbox is empty.")
+
+    def remember_menu(self):
+        """Record the current menu with the session, so resuming the session returns to it"""
+        if self.user is not None and self.user.session_token is not None:
+            SessionTokens.remember(self.user.session_token, self.menu.state)
+
+    def resume_session(self, token):
+        """
+        Log the client in with the session token it presented in its handshake answer
+        and return it to the menu it was in, without a password round trip.
+        """
+        try:
+            user, menu = User.resume(token)
+        except (KeyError, ValueError) as e:
+            logging.info(f"Session resumption from {self.address} refused: {e}")
+            self.send("Session expired, please log in again.", status="error")
+            return
+        except OSError as e:
+            logging.error(f"Session resumption failed: {e}")
+            self.send("Session could not be resumed, please log in again.", status="error")
+            return
+        self.user = user
+        logging.info(f"User {user.username} resumed a session from {self.address}")
+        with self.batch():
+            self.send(f"Welcome back, {user.username}!", ({"username": user.username, "token": token}, "session"),
+                      prompt=False)
+            self.menu.restore_state(menu)
+
+    def get_user_data(self, username=None):
+        """Retrieve single user information"""
+        try:
+            user_data = User.get(username)
+            self.send("", (user_data, "tabular"))
+        except KeyError as e:
+            self.send(f"User {username} not found!", status="error")
+            logging.info(f"Failed to retrieve user data - user not found: {e}")
+        except ValueError as e:
+            self.send(f"Invalid username format!", status="error")
+            logging.info(f"Failed to retrieve user data - invalid data format: {e}")
+        except OSError as e:
+            self.send(f"Operation failed! Please try again later", status="error")
+            logging.info(f"Failed to retrieve user data due to the following error: {e}")
+
+    def get_all_users(self, page_size=100):
+        """
+        Stream all user records to the client, one page of rows per frame. Each page is
+        written as soon as it has been read, so neither side holds the whole table.
+        """
+        try:
+            listed = 0
+            for page in User.iter_pages(page_size):
+                if listed:
+                    self.send("", (page, "rows"), prompt=False)
+                else:
+                    self.send("All Users:", (page, "tabular"), prompt=False)
+                self.com_protocol.flush()
+                listed += len(page)
+            if listed:
+                self.send(f"{listed} users listed.")
+            else:
+                self.send("No users found in the system.")
+        except Exception as e:
+            logging.error(f"Failed to retrieve user data: {e}")
+            self.send("Failed to retrieve user data", status="error")
+
+    def get_filtered_users(self, role=None, email_prefix=None, limit=100):
+        """Retrieve and display the users matching a role and/or email prefix"""
+        try:
+            user_data = User.filter(role=role, email_prefix=email_prefix, limit=limit)
+        except ValueError as e:
+            self.send(f"Invalid filter: {e}", status="error")
+            return
+        except OSError as e:
+            self.send("Operation failed! Please try again later", status="error")
+            logging.info(f"Failed to filter users due to the following error: {e}")
+            return
+        if user_data:
+            self.send(f"{len(user_data)} matching users:", (user_data, "tabular"))
+        else:
+            self.send("No matching users found.")
+
+    def get_users_page(self, page_size, cursor=None):
+        """Send a single page of user records along with the cursor of the next page"""
+        try:
+            page, next_cursor = User.get_page(cursor, page_size)
+        except ValueError as e:
+            self.send("Invalid page cursor!", status="error")
+            logging.info(f"Failed to retrieve user page: {e}")
+            return
+        except OSError as e:
+            self.send("Operation failed! Please try again later", status="error")
+            logging.info(f"Failed to retrieve user page due to the following error: {e}")
+            return
+        if not page:
+            self.send("No more users.")
+            return
+        message = f"Next page cursor: {next_cursor}" if next_cursor else "Last page."
+        self.send(message, ({"users": page, "next_cursor": next_cursor}, "page"))
+
+    def serve_next(self):
+        """
+        Receive a single request from the client and execute it.
+        Returns True while the session should stay open, False otherwise
+        """
+        try:
+            request = self.receive()
+            if request.get("status") == "handshake":
+                self.com_protocol.accept_handshake(request)
+                token = (request.get("data") or {}).get("token")
+                if token and not self.user:
+                    self.resume_session(token)
+                return True
+            if request.get("status") == "close":
+                logging.info(f"Client {self.address} closed the connection")
+                self.com_protocol.acknowledge_close()
+                return False
+            client_msg = request["message"]
+            if not client_msg:
+                logging.info("Client closed connection")
+                return False
+            if not self.menu.handle_command(client_msg):
+                logging.info("Client requested shutdown - closing connection")
+                return False
+        except ConnectionError as e:
+            print(f"Connection has been lost: {e}")
+            return False
+        except RuntimeError as e:
+            logging.error(f"Error processing message from {self.address}: {e}")
+            try:
+                self.send("An error occurred processing your request. Please try again.", status="error")
+                if not self.user or not self.user.is_logged_in:
+                    self.menu.update_menu_state()
+            except ConnectionError:
+                logging.error(f"Failed to send error message to client {self.address}")
+                return False
+        except Exception as e:
+            logging.error(f"Unexpected error: {e}")
+            try:
+                self.send("An error occurred. Please try again.", status="error")
+            except (ConnectionError, OSError) as e:
+                logging.error(f"Failed to send error message - connection lost: {e}")
+                return False
+            except Exception as e:
+                logging.error(f"Failed to send error message - unexpected error: {e}")
+                return False
+        return True
+
+    def run(self):
+        """Serve requests until the client disconnects"""
+        try:
+            self.open()
+            while self.serve_next():
+                pass
+        finally:
+            self.cleanup()
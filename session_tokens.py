@@ -0,0 +1,166 @@
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+
+from db_manager import DbManager
+
+
+class SessionTokens:
+    """
+    Signed, expiring tokens that let a client resume its session on a new connection
+    without sending its password again.
+
+    A token carries a session id, the username and the expiry time, signed with
+    HMAC-SHA256. Sessions issued by this process are also kept in an in-memory table
+    holding the menu the client was in. A validly signed token this process has no
+    entry for (issued by another worker, or before a restart with the same secret) is
+    accepted and resumes at the main menu.
+
+    Logging out is recorded in the database's sessions table, so a logged-out token
+    is refused by every worker sharing the database, and after a restart too.
+    """
+
+    ttl = 3600
+    _secret = os.urandom(32)
+    # session id -> {"username", "expires", "menu"}; the menu is None once logged out
+    _sessions = {}
+    _prune_at = 1024
+    _lock = threading.Lock()
+
+    @classmethod
+    def configure(cls, secret=None, ttl=3600):
+        """
+        Args:
+            secret (bytes, optional): Signing key shared by all processes that should
+                accept each other's tokens. Defaults to a random key for this process
+            ttl (int): Seconds a token stays valid
+
+        Raises:
+            ValueError: If ttl isn't positive
+        """
+        if ttl < 1:
+            raise ValueError("Session lifetime must be positive")
+        cls._secret = secret or os.urandom(32)
+        cls.ttl = ttl
+        with cls._lock:
+            cls._sessions = {}
+
+    @staticmethod
+    def _encode(data):
+        return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+    @staticmethod
+    def _decode(text):
+        return base64.b64decode(text + "=" * (-len(text) % 4), altchars=b"-_", validate=True)
+
+    @classmethod
+    def _sign(cls, payload):
+        return cls._encode(hmac.new(cls._secret, payload.encode("ascii"), hashlib.sha256).digest())
+
+    @classmethod
+    def issue(cls, username):
+        """
+        Start a session for a user who just authenticated.
+
+        Returns:
+            str: The session token to hand to the client
+        """
+        session_id = secrets.token_urlsafe(16)
+        expires = int(time.time()) + cls.ttl
+        payload = cls._encode(json.dumps({"sid": session_id, "user": username, "exp": expires}).encode("utf-8"))
+        with cls._lock:
+            cls._sessions[session_id] = {"username": username, "expires": expires, "menu": "main"}
+            if len(cls._sessions) >= cls._prune_at:
+                cls._prune()
+        return f"{payload}.{cls._sign(payload)}"
+
+    @classmethod
+    def _prune(cls):
+        """Drop expired sessions. Must be called with the lock held."""
+        now = time.time()
+        cls._sessions = {session_id: session for session_id, session in cls._sessions.items()
+                         if session["expires"] > now}
+        cls._prune_at = max(2 * len(cls._sessions), 1024)
+
+    @classmethod
+    def _claims(cls, token):
+        """
+        Check a token's signature and expiry and return its claims.
+
+        Raises:
+            ValueError: If the token is malformed, forged or expired
+        """
+        if not isinstance(token, str) or token.count(".") != 1:
+            raise ValueError("Malformed session token")
+        payload, signature = token.split(".")
+        if not hmac.compare_digest(signature, cls._sign(payload)):
+            raise ValueError("Invalid session token signature")
+        try:
+            claims = json.loads(cls._decode(payload))
+        except (ValueError, UnicodeDecodeError) as e:
+            raise ValueError(f"Malformed session token: {e}") from e
+        if not isinstance(claims, dict) or not {"sid", "user", "exp"} <= claims.keys():
+            raise ValueError("Malformed session token")
+        if claims["exp"] <= time.time():
+            raise ValueError("Session token has expired")
+        return claims
+
+    @classmethod
+    def validate(cls, token):
+        """
+        Check a token presented on a new connection.
+
+        Returns:
+            tuple: The session's username and the menu to resume in
+
+        Raises:
+            ValueError: If the token is invalid, expired or logged out
+            OSError: If the sessions table can't be read
+        """
+        claims = cls._claims(token)
+        if DbManager.session_revoked(claims["sid"]):
+            raise ValueError("Session has been logged out")
+        with cls._lock:
+            if claims["sid"] not in cls._sessions:
+                return claims["user"], "main"
+            session = cls._sessions[claims["sid"]]
+        if session["menu"] is None:
+            raise ValueError("Session has been logged out")
+        return session["username"], session["menu"]
+
+    @classmethod
+    def remember(cls, token, menu):
+        """Record the menu a session was in, to resume it there on the next connection"""
+        try:
+            claims = cls._claims(token)
+        except ValueError:
+            return
+        with cls._lock:
+            session = cls._sessions.setdefault(claims["sid"], {"username": claims["user"], "expires": claims["exp"],
+                                                                "menu": menu})
+            if session["menu"] is not None:
+                session["menu"] = menu
+
+    @classmethod
+    def revoke(cls, token):
+        """
+        End a session, so its token is no longer accepted by any process sharing the database.
+
+        Raises:
+            OSError: If the end of the session can't be recorded in the database
+        """
+        try:
+            claims = cls._claims(token)
+        except ValueError:
+            return
+        with cls._lock:
+            # kept until it expires, so the token isn't accepted as one from another process
+            cls._sessions[claims["sid"]] = {"username": claims["user"], "expires": claims["exp"], "menu": None}
+        DbManager.revoke_session(claims["sid"], claims["exp"])
+        logging.info(f"Session of {claims['user']} ended")
@@ -0,0 +1,1382 @@
+import bisect
+import fcntl
+import hashlib
+import heapq
+import json
+import logging
+import mmap
+import os
+import queue
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+from concurrent.futures import Future
+from contextlib import contextmanager, suppress
+from itertools import islice
+
+
+def file_stamp(path):
+    """Identify the current version of a file by its inode, mtime and size"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def read_json(path):
+    """
+    Read a JSON table from disk.
+
+    Returns:
+        dict: File contents or empty dict if the file doesn't exist
+
+    Raises:
+        PermissionError: If file exists but can't be accessed
+        ValueError: If the file is corrupted
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as db:
+            return json.load(db)
+    except FileNotFoundError:
+        return {}
+    except json.JSONDecodeError as e:
+        logging.error(f"Corrupted database file: {e}")
+        raise ValueError(f"Database file is corrupted: {e}") from e
+    except PermissionError as e:
+        logging.error(f"Permission denied accessing database: {e}")
+        raise
+    except OSError as e:
+        logging.error(f"OS error accessing database: {e}")
+        raise
+
+
+def replace_json(path, data):
+    """
+    Atomically replace a JSON table on disk: the data is written and synced to a
+    temporary file which is then renamed over the old one, so readers and crashes
+    only ever see the complete old or new table.
+
+    Raises:
+        TypeError: If data is not JSON serializable
+        OSError: If file system error occurs
+    """
+    temp_path = f"{path}.tmp"
+    try:
+        with open(temp_path, "w", encoding="utf-8") as db:
+            json.dump(data, db, indent=4)
+            db.flush()
+            os.fsync(db.fileno())
+        os.replace(temp_path, path)
+    except BaseException as e:
+        # whatever interrupted the write (e.g. a full disk), don't leave the partial table behind
+        with suppress(FileNotFoundError):
+            os.unlink(temp_path)
+        if isinstance(e, TypeError):
+            raise TypeError(f"Data is not JSON serializable: {e}") from e
+        raise
+    sync_directory(path)
+
+
+def sync_directory(path):
+    """Fsync the directory containing path, making a rename within it durable"""
+    directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+
+@contextmanager
+def file_lock(fd, operation=fcntl.LOCK_EX):
+    """Hold an flock on fd for the duration of the block"""
+    fcntl.flock(fd, operation)
+    try:
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+class VersionConflict(ValueError):
+    """Raised when a conditional change finds the record at a different version than expected"""
+
+
+def record_version(record):
+    """
+    Return the version of a stored record: 0 if there is no record, and 1 for
+    records written before versions were introduced.
+    """
+    if record is None:
+        return 0
+    return record.get("version", 1)
+
+
+def check_version(key, version, expected_version):
+    """
+    Raises:
+        VersionConflict: If expected_version is given and differs from the record's version
+    """
+    if expected_version is not None and version != expected_version:
+        raise VersionConflict(f"Record {key} is at version {version}, expected version {expected_version}")
+
+
+def public_record(record):
+    """Return a copy of a stored record without its version"""
+    return {field: value for field, value in record.items() if field != "version"}
+
+
+class ReadWriteLock:
+    """
+    Lock held either by any number of readers or by a single writer. Waiting writers
+    go before new readers, so a steady stream of reads can't starve writes. The writer
+    may acquire the lock again, for reading or writing, while it holds it; readers
+    must not nest acquisitions or try to upgrade to writing.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._writer_depth = 0
+        self._waiting_writers = 0
+
+    def acquire_read(self):
+        with self._condition:
+            if self._writer == threading.get_ident():
+                self._writer_depth += 1
+                return
+            while self._writer is not None or self._waiting_writers:
+                self._condition.wait()
+            self._readers += 1
+
+    def release_read(self):
+        with self._condition:
+            if self._writer == threading.get_ident():
+                self._release_writer()
+                return
+            self._readers -= 1
+            if not self._readers:
+                self._condition.notify_all()
+
+    def acquire_write(self):
+        with self._condition:
+            if self._writer == threading.get_ident():
+                self._writer_depth += 1
+                return
+            self._waiting_writers += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._condition.wait()
+            finally:
+                self._waiting_writers -= 1
+            self._writer = threading.get_ident()
+            self._writer_depth = 1
+
+    def release_write(self):
+        with self._condition:
+            if self._writer != threading.get_ident():
+                raise RuntimeError("Write lock released by a thread that doesn't hold it")
+            self._release_writer()
+
+    def _release_writer(self):
+        self._writer_depth -= 1
+        if not self._writer_depth:
+            self._writer = None
+            self._condition.notify_all()
+
+    @contextmanager
+    def read(self):
+        """Hold the lock for reading for the duration of the block"""
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write(self):
+        """Hold the lock for writing for the duration of the block"""
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
+class StampChain:
+    """
+    The database stamps this process's own commits went from and to. Each commit is
+    recorded with the stamp taken before it and the one taken after it while the
+    database was locked against other processes, so nobody else's change lies between
+    the two. Following the chain from a stamp therefore tells what the database
+    looks like now if only this process changed it since.
+    """
+
+    def __init__(self, size=64):
+        """
+        Args:
+            size (int): Number of most recent commits remembered
+        """
+        self.size = size
+        self._next = {}
+        self._lock = threading.Lock()
+
+    def record(self, before, after):
+        with self._lock:
+            self._next.pop(before, None)
+            self._next[before] = after
+            if len(self._next) > self.size:
+                del self._next[next(iter(self._next))]
+
+    def follow(self, stamp):
+        """Return the stamp reached from stamp through recorded commits, stamp if there are none"""
+        with self._lock:
+            for _ in range(len(self._next)):
+                if stamp not in self._next:
+                    break
+                stamp = self._next[stamp]
+        return stamp
+
+
+class FieldIndex:
+    """
+    Secondary index from the values of one record field to the keys of the records
+    holding them. Distinct values are also kept sorted, for prefix queries.
+    """
+
+    fields = ("email", "role")
+
+    def __init__(self, field):
+        self.field = field
+        # value -> keys, in a dict used as an insertion-ordered set
+        self._keys = {}
+        self._values = []
+
+    @classmethod
+    def build(cls, records):
+        """Index (key, record) pairs on every indexed field"""
+        indexes = {field: cls(field) for field in cls.fields}
+        for key, record in records:
+            for index in indexes.values():
+                index.add(key, record)
+        return indexes
+
+    @staticmethod
+    def update(indexes, key, previous, record):
+        """Move key from the index entries of its previous record to those of the new one"""
+        for index in indexes.values():
+            if previous is not None:
+                index.discard(key, previous)
+            if record is not None:
+                index.add(key, record)
+
+    def add(self, key, record):
+        value = record.get(self.field)
+        if not isinstance(value, str):
+            return
+        keys = self._keys.get(value)
+        if keys is None:
+            keys = self._keys[value] = {}
+            bisect.insort(self._values, value)
+        keys[key] = None
+
+    def discard(self, key, record):
+        value = record.get(self.field)
+        keys = self._keys.get(value) if isinstance(value, str) else None
+        if keys is None:
+            return
+        keys.pop(key, None)
+        if not keys:
+            del self._keys[value]
+            del self._values[bisect.bisect_left(self._values, value)]
+
+    def query(self, value=None, prefix=None):
+        """Iterate over the keys of the records whose field equals value, or starts with prefix"""
+        if value is not None:
+            yield from self._keys.get(value, ())
+            return
+        for position in range(bisect.bisect_left(self._values, prefix), len(self._values)):
+            candidate = self._values[position]
+            if not candidate.startswith(prefix):
+                return
+            yield from self._keys[candidate]
+
+
+def find_indexed(indexes, lookup, field, value, prefix, filters, limit):
+    """
+    Run a query against in-memory indexes.
+
+    Args:
+        indexes (dict): FieldIndex per indexed field
+        lookup (callable): Returns the record stored for a key
+        field (str): Indexed field to search
+        value (str, optional): Value the field must equal
+        prefix (str, optional): Prefix the field must start with
+        filters (dict, optional): Other fields and the values they must equal
+        limit (int, optional): Maximum number of results
+
+    Returns:
+        list: Matching (key, record) pairs
+    """
+    results = []
+    for key in indexes[field].query(value, prefix):
+        record = lookup(key)
+        if filters and any(record.get(name) != wanted for name, wanted in filters.items()):
+            continue
+        results.append((key, public_record(record)))
+        if limit is not None and len(results) >= limit:
+            break
+    return results
+
+
+class JsonStorage:
+    """
+    The whole table in a single JSON file. A process-wide copy of the table is kept
+    in memory and re-read only when the file changes. Tables are never modified in
+    place, so readers share the current one without holding any lock while they use it.
+
+    Changes are committed by a background thread: mutations arriving from concurrent
+    callers within commit_window seconds of each other are applied together and
+    written with a single atomic, fsynced file replacement, after which every caller
+    in the batch is woken. A save or delete returns once it is durable. Processes
+    sharing the file serialize their commits with an exclusive lock on a lock file
+    next to it, and each commit starts from the latest table on disk.
+    """
+
+    extension = ".json"
+
+    def __init__(self, path="users.json", commit_window=0.002):
+        """
+        Args:
+            path (str): Database file
+            commit_window (float, optional): Seconds to collect further mutations after
+                the first one of a batch, None to commit each mutation on the caller's thread
+        """
+        self.path = path
+        self.commit_window = commit_window
+        self.lock = ReadWriteLock()
+        self._commit_lock = threading.Lock()
+        self._lock_fd = os.open(f"{path}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+        self._cache = None
+        self._cache_stamp = None
+        # (table, its keys in order), valid while the table is current
+        self._sorted = (None, None)
+        self._indexes = None
+        self._indexed = None
+        self._pending = queue.SimpleQueue()
+        self._committer = None
+        self._stamps = StampChain()
+
+    def _load(self):
+        """
+        Return the current table, re-reading the database file only if it was changed
+        since it was cached (e.g. by another process).
+        """
+        stamp = file_stamp(self.path)
+        with self.lock.read():
+            if self._cache is not None and stamp == self._cache_stamp:
+                return self._cache
+        with self.lock.write():
+            if self._cache is None or stamp != self._cache_stamp:
+                self._cache = read_json(self.path)
+                self._cache_stamp = stamp
+            return self._cache
+
+    def _submit(self, operation, key, value=None, expected_version=None):
+        """Hand a mutation to the committer and wait until it has been written"""
+        future = Future()
+        mutation = (operation, key, value, expected_version, future)
+        if self.commit_window is None:
+            self._commit([mutation])
+        else:
+            with self.lock.write():
+                if self._committer is None:
+                    self._committer = threading.Thread(target=self._run_committer, name="json-committer",
+                                                       daemon=True)
+                    self._committer.start()
+            self._pending.put(mutation)
+        return future.result()
+
+    def _run_committer(self):
+        """Collect mutations into batches and commit them until the storage is closed"""
+        while True:
+            mutation = self._pending.get()
+            if mutation is None:
+                return
+            batch = [mutation]
+            deadline = time.monotonic() + self.commit_window
+            while mutation is not None:
+                try:
+                    mutation = self._pending.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if mutation is not None:
+                    batch.append(mutation)
+            try:
+                self._commit(batch)
+            except BaseException as e:
+                # fail this batch's callers instead of leaving them and every later caller waiting forever
+                logging.error(f"Unexpected error committing to {self.path}: {e!r}")
+                with self.lock.write():
+                    self._cache = None
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            if mutation is None:
+                return
+
+    @staticmethod
+    def _apply(data, operation, key, value, expected_version, changed):
+        """
+        Apply a single mutation to a table and return its result.
+
+        Raises:
+            KeyError: If a record to delete doesn't exist
+            VersionConflict: If the record isn't at the expected version
+        """
+        if operation == "save":
+            current = data.get(key)
+            check_version(key, record_version(current), expected_version)
+            data[key] = dict(value, version=record_version(current) + 1)
+            changed.add(key)
+            return data[key]["version"]
+        if operation == "delete":
+            if key not in data:
+                raise KeyError(f"No record found for {key}")
+            check_version(key, record_version(data[key]), expected_version)
+            del data[key]
+            changed.add(key)
+            return None
+        if operation == "save_many":
+            saved = []
+            for record_key, record in value.items():
+                version = record_version(data.get(record_key))
+                if expected_version is None or version == expected_version:
+                    data[record_key] = dict(record, version=version + 1)
+                    saved.append(record_key)
+            changed.update(saved)
+            return saved
+        deleted = [record_key for record_key in value if data.pop(record_key, None) is not None]
+        changed.update(deleted)
+        return deleted
+
+    def _commit(self, batch):
+        """
+        Apply a batch of mutations to a copy of the latest table, replace the database
+        file with it and report the outcome to each caller. A mutation that fails only
+        fails its own caller. Readers keep seeing the previous table until the new one
+        is durable.
+        """
+        with self._commit_lock, file_lock(self._lock_fd):
+            before = file_stamp(self.path)
+            try:
+                previous = self._load()
+            except (ValueError, OSError) as e:
+                for *_, future in batch:
+                    future.set_exception(e)
+                return
+            data = dict(previous)
+            applied = []
+            changed = set()
+            for operation, key, value, expected_version, future in batch:
+                try:
+                    result = self._apply(data, operation, key, value, expected_version, changed)
+                except (KeyError, VersionConflict) as e:
+                    future.set_exception(e)
+                    continue
+                applied.append((future, result))
+            if not applied:
+                return
+            try:
+                replace_json(self.path, data)
+            except (TypeError, OSError) as e:
+                with self.lock.write():
+                    self._cache = None
+                logging.error(f"Error writing to database: {e}")
+                for future, _ in applied:
+                    future.set_exception(e)
+                return
+            stamp = file_stamp(self.path)
+            self._stamps.record(before, stamp)
+            with self.lock.write():
+                self._cache, self._cache_stamp = data, stamp
+                sorted_table, keys = self._sorted
+                if sorted_table is previous and all((key in previous) == (key in data) for key in changed):
+                    self._sorted = (data, keys)
+                if self._indexed is previous:
+                    for key in changed:
+                        FieldIndex.update(self._indexes, key, previous.get(key), data.get(key))
+                    self._indexed = data
+        for future, result in applied:
+            future.set_result(result)
+
+    def get(self, key):
+        data = self._load()
+        if key not in data:
+            raise KeyError(f"No record found for {key}")
+        return public_record(data[key])
+
+    def get_all(self):
+        return {key: public_record(record) for key, record in self._load().items()}
+
+    def keys(self):
+        return list(self._load())
+
+    def stamp(self):
+        """Return a value that changes whenever any process commits a change"""
+        return file_stamp(self.path)
+
+    def advance_stamp(self, stamp):
+        """Return the stamp the database has after this process's own commits made since stamp"""
+        return self._stamps.follow(stamp)
+
+    def get_version(self, key):
+        return record_version(self._load().get(key))
+
+    def scan(self, after, limit):
+        data = self._load()
+        sorted_table, keys = self._sorted
+        if sorted_table is not data:
+            keys = sorted(data)
+            self._sorted = (data, keys)
+        start = 0 if after is None else bisect.bisect_right(keys, after)
+        return [(key, public_record(data[key])) for key in keys[start:start + limit]]
+
+    def find(self, field, value=None, prefix=None, filters=None, limit=None):
+        while True:
+            data = self._load()
+            # the indexes are updated in place by commits, so they are only read under the lock
+            with self.lock.read():
+                if self._indexed is data:
+                    return find_indexed(self._indexes, data.__getitem__, field, value, prefix, filters, limit)
+            indexes = FieldIndex.build(data.items())
+            with self.lock.write():
+                if self._cache is data:
+                    self._indexes, self._indexed = indexes, data
+
+    def save(self, key, value, expected_version=None):
+        try:
+            json.dumps(value)
+        except TypeError as e:
+            logging.error(f"Invalid data format for JSON serialization: {e}")
+            raise TypeError(f"Data is not JSON serializable: {e}") from e
+        return self._submit("save", key, dict(value), expected_version)
+
+    def save_many(self, records, expected_version=None):
+        try:
+            json.dumps(records)
+        except TypeError as e:
+            logging.error(f"Invalid data format for JSON serialization: {e}")
+            raise TypeError(f"Data is not JSON serializable: {e}") from e
+        return self._submit("save_many", None, {key: dict(value) for key, value in records.items()},
+                            expected_version)
+
+    def delete(self, key, expected_version=None):
+        self._submit("delete", key, expected_version=expected_version)
+
+    def delete_many(self, keys):
+        return self._submit("delete_many", None, list(dict.fromkeys(keys)))
+
+    def close(self):
+        """Commit the pending mutations and stop the committer"""
+        with self.lock.write():
+            committer, self._committer = self._committer, None
+        if committer is not None:
+            self._pending.put(None)
+            committer.join()
+        with self.lock.write():
+            self._cache = None
+            if self._lock_fd is not None:
+                os.close(self._lock_fd)
+                self._lock_fd = None
+
+
+class LogStorage:
+    """
+    Log-structured storage. Every change is appended to a log file as a single JSON
+    line and applied to an in-memory table, so a write costs O(record) and a crash
+    can at worst lose the line being written. The table is rebuilt from the last
+    snapshot plus the log, and the log is folded into a new snapshot once it holds
+    more entries than the table has records.
+
+    The snapshot has the same format as the JSON backend's file, so an existing
+    users.json can be used as the initial snapshot. Processes sharing the files
+    serialize writes with an exclusive lock on the log and pick up each other's
+    changes by reading the log from where they left off.
+
+    Within a process, readers share the table under a read-write lock and only a
+    change, or catching up with another process's changes, holds it exclusively.
+    Every record carries a version that a change can be made conditional on.
+    """
+
+    extension = ".json"
+
+    def __init__(self, path="users.json", log_path=None, compact_after=1000, sync=True):
+        """
+        Args:
+            path (str): Snapshot file
+            log_path (str, optional): Log file, defaults to the snapshot path plus ".log"
+            compact_after (int): Minimum number of log entries before compaction
+            sync (bool): Fsync the log after every append
+        """
+        self.path = path
+        self.log_path = log_path or f"{path}.log"
+        self.compact_after = compact_after
+        self.sync = sync
+        self.lock = ReadWriteLock()
+        self._fd = os.open(self.log_path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self._data = None
+        self._snapshot_stamp = None
+        self._log_offset = 0
+        self._log_entries = 0
+        self._sorted_keys = None
+        self._indexes = None
+        self._stamps = StampChain()
+
+    def _refresh(self):
+        """Bring the in-memory table up to date with the snapshot and the log"""
+        log_size = os.fstat(self._fd).st_size
+        stamp = file_stamp(self.path)
+        if self._data is None or stamp != self._snapshot_stamp or log_size < self._log_offset:
+            self._load_snapshot()
+            self._sorted_keys = None
+            self._indexes = None
+            self._snapshot_stamp = stamp
+            self._log_offset = 0
+            self._log_entries = 0
+        if log_size > self._log_offset:
+            self._replay(os.pread(self._fd, log_size - self._log_offset, self._log_offset))
+        return log_size
+
+    def _replay(self, chunk):
+        """Apply the complete log lines in chunk. A trailing partial line is left unread."""
+        end = chunk.rfind(b"\n") + 1
+        for line in chunk[:end].splitlines():
+            try:
+                self._log_entries += self._apply(json.loads(line))
+            except (ValueError, KeyError) as e:
+                logging.error(f"Skipping corrupted log entry in {self.log_path}: {e}")
+        self._log_offset += end
+
+    def _load_snapshot(self):
+        """Replace the in-memory table with the snapshot's contents"""
+        self._data = read_json(self.path)
+
+    def _write_snapshot(self):
+        """Replace the snapshot with the in-memory table"""
+        replace_json(self.path, self._data)
+
+    def _lookup(self, key):
+        """Return the current record for key, None if there is none"""
+        return self._data.get(key)
+
+    def _records(self):
+        """Return an iterable of the current (key, record) pairs"""
+        return self._data.items()
+
+    def _table_size(self):
+        return len(self._data)
+
+    def _put(self, key, record):
+        if self._sorted_keys is not None or self._indexes is not None:
+            previous = self._lookup(key)
+            if previous is None:
+                self._sorted_keys = None
+            if self._indexes is not None:
+                FieldIndex.update(self._indexes, key, previous, record)
+        self._data[key] = record
+
+    def _remove(self, key):
+        self._sorted_keys = None
+        if self._indexes is not None:
+            FieldIndex.update(self._indexes, key, self._lookup(key), None)
+        self._data.pop(key, None)
+
+    def _apply(self, entry):
+        """Apply a log entry to the table and return the number of records it changed"""
+        operation = entry["op"]
+        if operation == "save":
+            self._put(entry["key"], entry["value"])
+            return 1
+        if operation == "delete":
+            self._remove(entry["key"])
+            return 1
+        if operation == "save_many":
+            for key, record in entry["records"].items():
+                self._put(key, record)
+            return len(entry["records"])
+        if operation == "delete_many":
+            for key in entry["keys"]:
+                self._remove(key)
+            return len(entry["keys"])
+        raise ValueError(f"Unknown log operation: {operation}")
+
+    def _is_current(self):
+        """Whether the table holds the current snapshot and every complete log entry"""
+        return (self._data is not None and os.fstat(self._fd).st_size == self._log_offset
+                and file_stamp(self.path) == self._snapshot_stamp)
+
+    @contextmanager
+    def _reading(self):
+        """
+        Hold the table up to date for reading for the duration of the block. Readers
+        share the lock unless the files have changed, in which case the table is
+        brought up to date, and read, under the write lock.
+        """
+        with self.lock.read():
+            if self._is_current():
+                yield
+                return
+        with self.lock.write():
+            with file_lock(self._fd, fcntl.LOCK_SH):
+                self._refresh()
+            yield
+
+    def _append(self, entry, check=None):
+        """
+        Append a change to the log and apply it.
+
+        Args:
+            entry (dict): Log entry with "op" and the operation's arguments
+            check (callable, optional): Called once the table is up to date, before
+                anything is written. May raise to reject the change, or complete the entry
+        """
+        with self.lock.write(), file_lock(self._fd):
+            if self._refresh() > self._log_offset:
+                # no other writer holds the lock, so this is a line torn by a crash
+                os.ftruncate(self._fd, self._log_offset)
+            before = file_stamp(self.path), self._log_offset
+            if check is not None:
+                check()
+            line = json.dumps(entry, separators=(",", ":")).encode("utf-8") + b"\n"
+            os.write(self._fd, line)
+            if self.sync:
+                os.fsync(self._fd)
+            self._log_offset += len(line)
+            self._log_entries += self._apply(entry)
+            if self._log_entries >= max(self.compact_after, self._table_size()):
+                self._compact()
+            self._stamps.record(before, self.stamp())
+
+    def _compact(self):
+        """
+        Write the table as a new snapshot and empty the log. Must be called with the
+        log locked. A crash before the log is truncated only means its entries are
+        replayed again on top of the new snapshot.
+        """
+        self._write_snapshot()
+        os.ftruncate(self._fd, 0)
+        self._snapshot_stamp = file_stamp(self.path)
+        self._log_offset = 0
+        self._log_entries = 0
+        logging.info(f"Compacted {self.log_path} into {self.path}")
+
+    def compact(self):
+        """Fold the log into a new snapshot now"""
+        with self.lock.write(), file_lock(self._fd):
+            before = file_stamp(self.path), self._refresh()
+            self._compact()
+            self._stamps.record(before, self.stamp())
+
+    def get(self, key):
+        with self._reading():
+            record = self._lookup(key)
+            if record is None:
+                raise KeyError(f"No record found for {key}")
+            return public_record(record)
+
+    def get_all(self):
+        with self._reading():
+            return {key: public_record(record) for key, record in self._records()}
+
+    def keys(self):
+        with self._reading():
+            return [key for key, _ in self._records()]
+
+    def stamp(self):
+        """Return a value that changes whenever any process appends or compacts"""
+        return file_stamp(self.path), os.fstat(self._fd).st_size
+
+    def advance_stamp(self, stamp):
+        """Return the stamp the database has after this process's own commits made since stamp"""
+        return self._stamps.follow(stamp)
+
+    def get_version(self, key):
+        with self._reading():
+            return record_version(self._lookup(key))
+
+    def scan(self, after, limit):
+        with self._reading():
+            # concurrent readers may both build the derived structures; either result is valid
+            keys = self._sorted_keys
+            if keys is None:
+                keys = self._sorted_keys = sorted(key for key, _ in self._records())
+            start = 0 if after is None else bisect.bisect_right(keys, after)
+            return [(key, public_record(self._lookup(key))) for key in keys[start:start + limit]]
+
+    def find(self, field, value=None, prefix=None, filters=None, limit=None):
+        with self._reading():
+            indexes = self._indexes
+            if indexes is None:
+                indexes = self._indexes = FieldIndex.build(self._records())
+            return find_indexed(indexes, self._lookup, field, value, prefix, filters, limit)
+
+    def save(self, key, value, expected_version=None):
+        # versions are assigned under the log lock, so replaying the log reproduces them
+        entry = {"op": "save", "key": key, "value": dict(value)}
+
+        def check():
+            current = self._lookup(key)
+            check_version(key, record_version(current), expected_version)
+            entry["value"]["version"] = record_version(current) + 1
+        self._append(entry, check)
+        return entry["value"]["version"]
+
+    def delete(self, key, expected_version=None):
+        def check():
+            current = self._lookup(key)
+            if current is None:
+                raise KeyError(f"No record found for {key}")
+            check_version(key, record_version(current), expected_version)
+        self._append({"op": "delete", "key": key}, check)
+
+    def save_many(self, records, expected_version=None):
+        entry = {"op": "save_many", "records": {}}
+
+        def check():
+            entry["records"] = {}
+            for key, value in records.items():
+                version = record_version(self._lookup(key))
+                if expected_version is None or version == expected_version:
+                    entry["records"][key] = dict(value, version=version + 1)
+        self._append(entry, check)
+        return list(entry["records"])
+
+    def delete_many(self, keys):
+        entry = {"op": "delete_many", "keys": []}
+
+        def check():
+            entry["keys"] = [key for key in dict.fromkeys(keys) if self._lookup(key) is not None]
+        self._append(entry, check)
+        return entry["keys"]
+
+    def close(self):
+        with self.lock.write():
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+
+class SnapshotFile:
+    """
+    Read-only table in a memory-mapped file, so processes reading the same snapshot
+    share its pages and a lookup decodes only the record it asks for.
+
+    The file starts with a header (magic, record count, index offset), followed by
+    the records, each a 4 byte length and the JSON encoded [key, record] pair, and
+    ends with the index: one (key hash, record offset) pair per record, sorted by
+    hash for binary search.
+    """
+
+    magic = b"USN1"
+    header = struct.Struct("<4sIQ")
+    length = struct.Struct("<I")
+    index_entry = struct.Struct("<QQ")
+
+    def __init__(self, path):
+        """
+        Raises:
+            ValueError: If the file isn't a snapshot
+        """
+        self.path = path
+        self._map = None
+        self.count = 0
+        self._index_offset = 0
+        try:
+            with open(path, "rb") as snapshot:
+                if os.fstat(snapshot.fileno()).st_size:
+                    self._map = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return
+        if self._map is None:
+            return
+        magic, self.count, self._index_offset = self.header.unpack_from(self._map, 0)
+        if magic != self.magic:
+            self.close()
+            raise ValueError(f"{path} is not a user snapshot")
+
+    @staticmethod
+    def key_hash(key):
+        return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little")
+
+    def _index_hash(self, position):
+        return self.index_entry.unpack_from(self._map, self._index_offset + position * self.index_entry.size)
+
+    def _decode(self, offset):
+        size, = self.length.unpack_from(self._map, offset)
+        start = offset + self.length.size
+        return json.loads(self._map[start:start + size])
+
+    def get(self, key):
+        """Return the record for key, None if the snapshot doesn't have one"""
+        if not self.count:
+            return None
+        wanted = self.key_hash(key)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._index_hash(middle)[0] < wanted:
+                low = middle + 1
+            else:
+                high = middle
+        while low < self.count:
+            key_hash, offset = self._index_hash(low)
+            if key_hash != wanted:
+                break
+            record_key, record = self._decode(offset)
+            if record_key == key:
+                return record
+            low += 1
+        return None
+
+    def items(self):
+        """Iterate over all (key, record) pairs in file order"""
+        offset = self.header.size
+        for _ in range(self.count):
+            record_key, record = self._decode(offset)
+            yield record_key, record
+            offset += self.length.size + self.length.unpack_from(self._map, offset)[0]
+
+    def __len__(self):
+        return self.count
+
+    @classmethod
+    def write(cls, path, records):
+        """
+        Atomically replace the snapshot at path with the given (key, record) pairs.
+
+        Raises:
+            TypeError: If a record is not JSON serializable
+            OSError: If file system error occurs
+        """
+        temp_path = f"{path}.tmp"
+        index = []
+        try:
+            with open(temp_path, "wb") as snapshot:
+                snapshot.write(bytes(cls.header.size))
+                offset = cls.header.size
+                for key, record in records:
+                    encoded = json.dumps([key, record], separators=(",", ":")).encode("utf-8")
+                    snapshot.write(cls.length.pack(len(encoded)))
+                    snapshot.write(encoded)
+                    index.append((cls.key_hash(key), offset))
+                    offset += cls.length.size + len(encoded)
+                index.sort()
+                snapshot.write(b"".join(cls.index_entry.pack(*entry) for entry in index))
+                snapshot.seek(0)
+                snapshot.write(cls.header.pack(cls.magic, len(index), offset))
+                snapshot.flush()
+                os.fsync(snapshot.fileno())
+            os.replace(temp_path, path)
+        except TypeError as e:
+            os.unlink(temp_path)
+            raise TypeError(f"Data is not JSON serializable: {e}") from e
+        sync_directory(path)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+
+class MappedStorage(LogStorage):
+    """
+    Log-structured storage whose snapshot is a memory-mapped SnapshotFile instead of
+    a JSON table. Only the changes logged since the last compaction are held in
+    memory; every other lookup decodes a single record from the shared mapping.
+    """
+
+    extension = ".snap"
+
+    def __init__(self, path="users.snap", **options):
+        self._snapshot = None
+        super().__init__(path=path, **options)
+
+    def _load_snapshot(self):
+        if self._snapshot is not None:
+            self._snapshot.close()
+        self._snapshot = SnapshotFile(self.path)
+        # records changed since the snapshot was written, None marks a deleted record
+        self._data = {}
+
+    def _write_snapshot(self):
+        SnapshotFile.write(self.path, list(self._records()))
+        self._load_snapshot()
+
+    def _lookup(self, key):
+        if key in self._data:
+            return self._data[key]
+        return self._snapshot.get(key)
+
+    def _records(self):
+        for key, record in self._snapshot.items():
+            if key not in self._data:
+                yield key, record
+        for key, record in self._data.items():
+            if record is not None:
+                yield key, record
+
+    def _table_size(self):
+        return len(self._snapshot) + len(self._data)
+
+    def _remove(self, key):
+        super()._remove(key)
+        self._data[key] = None
+
+    def close(self):
+        with self.lock.write():
+            super().close()
+            if self._snapshot is not None:
+                self._snapshot.close()
+
+
+class SqliteStorage:
+    """
+    Users in a SQLite database, keyed by username with indexes on email and role.
+    Single records are looked up through the primary key, so nothing but the
+    requested row is read. The database runs in WAL mode, letting readers in any
+    thread or process proceed while a write is in progress. Conditional changes read
+    and compare the row's version within the same write transaction.
+    """
+
+    extension = ".db"
+    columns = ("password_hash", "email", "role")
+    upsert = ("INSERT INTO users (username, password_hash, email, role, extra) VALUES (?, ?, ?, ?, ?) "
+              "ON CONFLICT (username) DO UPDATE SET password_hash = excluded.password_hash, "
+              "email = excluded.email, role = excluded.role, extra = excluded.extra, version = users.version + 1")
+
+    def __init__(self, path="users.db", timeout=5.0):
+        """
+        Args:
+            path (str): Database file
+            timeout (float): Seconds to wait for another process's write lock
+        """
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._stamps = StampChain()
+        with self._errors():
+            connection = self._connection()
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS users ("
+                "username TEXT PRIMARY KEY, password_hash TEXT, email TEXT, role TEXT, extra TEXT, "
+                "version INTEGER NOT NULL DEFAULT 1)")
+            if "version" not in [row[1] for row in connection.execute("PRAGMA table_info(users)")]:
+                connection.execute("ALTER TABLE users ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+            connection.execute("CREATE INDEX IF NOT EXISTS users_email ON users (email)")
+            connection.execute("CREATE INDEX IF NOT EXISTS users_role ON users (role)")
+            # counts write transactions, for a stamp that can't miss a change the way file stats can
+            connection.execute("CREATE TABLE IF NOT EXISTS commits (id INTEGER PRIMARY KEY CHECK (id = 0), "
+                               "count INTEGER NOT NULL)")
+            connection.execute("INSERT OR IGNORE INTO commits (id, count) VALUES (0, 0)")
+
+    def _connection(self):
+        """Return the calling thread's connection, opening it on first use"""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None,
+                                         check_same_thread=False)
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
+
+    @staticmethod
+    @contextmanager
+    def _errors():
+        """Translate SQLite errors into the exceptions DbManager callers expect"""
+        try:
+            yield
+        except (sqlite3.InterfaceError, sqlite3.ProgrammingError) as e:
+            logging.error(f"Invalid data format for SQLite: {e}")
+            raise TypeError(f"Data can't be stored: {e}") from e
+        except sqlite3.DatabaseError as e:
+            logging.error(f"SQLite error accessing database: {e}")
+            raise OSError(f"Database error: {e}") from e
+
+    @classmethod
+    def _record(cls, row):
+        """Build a user record from a row, skipping the fields it doesn't have"""
+        record = {column: value for column, value in zip(cls.columns, row) if value is not None}
+        if row[len(cls.columns)] is not None:
+            record.update(json.loads(row[len(cls.columns)]))
+        return record
+
+    def get(self, key):
+        with self._errors():
+            row = self._connection().execute(
+                "SELECT password_hash, email, role, extra FROM users WHERE username = ?", (key,)).fetchone()
+        if row is None:
+            raise KeyError(f"No record found for {key}")
+        return self._record(row)
+
+    def get_all(self):
+        with self._errors():
+            rows = self._connection().execute(
+                "SELECT username, password_hash, email, role, extra FROM users").fetchall()
+        return {row[0]: self._record(row[1:]) for row in rows}
+
+    def keys(self):
+        with self._errors():
+            return [row[0] for row in self._connection().execute("SELECT username FROM users")]
+
+    def stamp(self):
+        """Return a value that changes whenever any process commits a transaction"""
+        with self._errors():
+            return self._connection().execute("SELECT count FROM commits").fetchone()[0]
+
+    def advance_stamp(self, stamp):
+        """Return the stamp the database has after this process's own commits made since stamp"""
+        return self._stamps.follow(stamp)
+
+    def find(self, field, value=None, prefix=None, filters=None, limit=None):
+        if value is not None:
+            conditions, parameters = [f"{field} = ?"], [value]
+        else:
+            # a range instead of LIKE, so the field's index is used
+            conditions, parameters = [f"{field} >= ?", f"{field} < ?"], [prefix, prefix + "\U0010ffff"]
+        for name, wanted in (filters or {}).items():
+            conditions.append(f"{name} = ?")
+            parameters.append(wanted)
+        with self._errors():
+            rows = self._connection().execute(
+                f"SELECT username, password_hash, email, role, extra FROM users WHERE {' AND '.join(conditions)} "
+                f"LIMIT ?", (*parameters, -1 if limit is None else limit)).fetchall()
+        return [(row[0], self._record(row[1:])) for row in rows]
+
+    def scan(self, after, limit):
+        with self._errors():
+            rows = self._connection().execute(
+                "SELECT username, password_hash, email, role, extra FROM users WHERE username > ? "
+                "ORDER BY username LIMIT ?", ("" if after is None else after, limit)).fetchall()
+        return [(row[0], self._record(row[1:])) for row in rows]
+
+    @classmethod
+    def _row(cls, key, value):
+        """Build the row stored for a user record"""
+        extra = {field: item for field, item in value.items() if field not in cls.columns and field != "version"}
+        try:
+            extra = json.dumps(extra) if extra else None
+        except TypeError as e:
+            raise TypeError(f"Data is not JSON serializable: {e}") from e
+        return key, *(value.get(column) for column in cls.columns), extra
+
+    @contextmanager
+    def _transaction(self):
+        """Run the block's statements as a single write transaction"""
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+            before = connection.execute("SELECT count FROM commits").fetchone()[0]
+            connection.execute("UPDATE commits SET count = count + 1")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        self._stamps.record(before, before + 1)
+
+    def get_version(self, key):
+        with self._errors():
+            row = self._connection().execute("SELECT version FROM users WHERE username = ?", (key,)).fetchone()
+        return 0 if row is None else row[0]
+
+    @staticmethod
+    def _current_version(connection, key):
+        row = connection.execute("SELECT version FROM users WHERE username = ?", (key,)).fetchone()
+        return 0 if row is None else row[0]
+
+    def save(self, key, value, expected_version=None):
+        row = self._row(key, value)
+        with self._errors(), self._transaction() as connection:
+            version = self._current_version(connection, key)
+            check_version(key, version, expected_version)
+            connection.execute(self.upsert, row)
+        return version + 1
+
+    def save_many(self, records, expected_version=None):
+        rows = {key: self._row(key, value) for key, value in records.items()}
+        with self._errors(), self._transaction() as connection:
+            if expected_version is not None:
+                keys = list(rows)
+                versions = {}
+                for start in range(0, len(keys), 500):
+                    chunk = keys[start:start + 500]
+                    placeholders = ", ".join("?" * len(chunk))
+                    versions.update(connection.execute(
+                        f"SELECT username, version FROM users WHERE username IN ({placeholders})", chunk))
+                rows = {key: row for key, row in rows.items() if versions.get(key, 0) == expected_version}
+            connection.executemany(self.upsert, rows.values())
+        return list(rows)
+
+    def delete(self, key, expected_version=None):
+        with self._errors(), self._transaction() as connection:
+            version = self._current_version(connection, key)
+            if not version:
+                raise KeyError(f"No record found for {key}")
+            check_version(key, version, expected_version)
+            connection.execute("DELETE FROM users WHERE username = ?", (key,))
+
+    def delete_many(self, keys):
+        keys = list(dict.fromkeys(keys))
+        deleted = []
+        with self._errors(), self._transaction() as connection:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                placeholders = ", ".join("?" * len(chunk))
+                deleted.extend(row[0] for row in connection.execute(
+                    f"SELECT username FROM users WHERE username IN ({placeholders})", chunk))
+                connection.execute(f"DELETE FROM users WHERE username IN ({placeholders})", chunk)
+        return deleted
+
+    def close(self):
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+
+class ShardedStorage:
+    """
+    Records hash-partitioned by key across several instances of another backend, each
+    with its own file in a shared directory. Every shard has its own lock (and, for
+    the JSON backend, its own committer), so changes to users on different shards
+    proceed in parallel and a change only rewrites its own shard. Full scans merge
+    all shards.
+
+    The shard count is recorded in the directory on first use; it can't be changed
+    afterwards, as that would move existing users to different shards.
+    """
+
+    def __init__(self, storage_class, shards=4, path="users", **options):
+        """
+        Args:
+            storage_class: Backend class storing each shard
+            shards (int): Number of shards
+            path (str): Directory holding the shard files
+            **options: Options passed to each shard's backend
+
+        Raises:
+            ValueError: If the directory holds a different number of shards
+        """
+        if shards < 1:
+            raise ValueError("Number of shards must be positive")
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._check_layout(storage_class, shards)
+        self.shards = [storage_class(path=os.path.join(path, f"shard-{index}{storage_class.extension}"), **options)
+                       for index in range(shards)]
+
+    def _check_layout(self, storage_class, shards):
+        layout_file = os.path.join(self.path, "shards.json")
+        layout = {"backend": storage_class.__name__, "shards": shards}
+        # processes opening a new directory together must agree on who writes the layout
+        lock_fd = os.open(f"{layout_file}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            with file_lock(lock_fd):
+                existing = read_json(layout_file)
+                if not existing:
+                    replace_json(layout_file, layout)
+                    return
+        finally:
+            os.close(lock_fd)
+        if existing != layout:
+            raise ValueError(f"{self.path} holds {existing['shards']} {existing['backend']} shards, "
+                             f"not {shards} {storage_class.__name__} shards")
+
+    def shard(self, key):
+        """Return the shard storing key. The hash is stable across processes and restarts."""
+        return self.shards[self._shard_index(key)]
+
+    def _shard_index(self, key):
+        return zlib.crc32(key.encode("utf-8")) % len(self.shards)
+
+    def get(self, key):
+        return self.shard(key).get(key)
+
+    def get_all(self):
+        data = {}
+        for shard in self.shards:
+            data.update(shard.get_all())
+        return data
+
+    def keys(self):
+        return [key for shard in self.shards for key in shard.keys()]
+
+    def stamp(self):
+        return tuple(shard.stamp() for shard in self.shards)
+
+    def advance_stamp(self, stamp):
+        if stamp is None:
+            return stamp
+        return tuple(shard.advance_stamp(shard_stamp) for shard, shard_stamp in zip(self.shards, stamp))
+
+    def find(self, field, value=None, prefix=None, filters=None, limit=None):
+        results = []
+        for shard in self.shards:
+            remaining = None if limit is None else limit - len(results)
+            if remaining == 0:
+                break
+            results.extend(shard.find(field, value, prefix, filters, remaining))
+        return results
+
+    def scan(self, after, limit):
+        pages = [shard.scan(after, limit) for shard in self.shards]
+        return list(islice(heapq.merge(*pages, key=lambda item: item[0]), limit))
+
+    def get_version(self, key):
+        return self.shard(key).get_version(key)
+
+    def save(self, key, value, expected_version=None):
+        return self.shard(key).save(key, value, expected_version)
+
+    def delete(self, key, expected_version=None):
+        self.shard(key).delete(key, expected_version)
+
+    def _partition(self, keys):
+        """Group keys by the index of their shard"""
+        partitions = {}
+        for key in keys:
+            partitions.setdefault(self._shard_index(key), []).append(key)
+        return partitions
+
+    def save_many(self, records, expected_version=None):
+        saved = []
+        for index, keys in self._partition(records).items():
+            saved.extend(self.shards[index].save_many({key: records[key] for key in keys}, expected_version))
+        return saved
+
+    def delete_many(self, keys):
+        deleted = []
+        for index, shard_keys in self._partition(keys).items():
+            deleted.extend(self.shards[index].delete_many(shard_keys))
+        return deleted
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+
+STORAGE_BACKENDS = {
+    "json": JsonStorage,
+    "log": LogStorage,
+    "mmap": MappedStorage,
+    "sqlite": SqliteStorage,
+}
@@ -0,0 +1,91 @@
+import logging
+import multiprocessing
+import signal
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from multiprocessing.connection import wait
+
+
+class Supervisor:
+    """
+    Runs a pool of worker processes, restarts the ones that crash and collects
+    their log records into a single log file.
+    """
+
+    def __init__(self, target, args=(), workers=2, log_file="server.log", restart_delay=1.0):
+        self.target = target
+        self.args = args
+        self.workers = workers
+        self.log_file = log_file
+        self.restart_delay = restart_delay
+        self.processes = {}
+        self.is_running = False
+        self._log_queue = multiprocessing.Queue()
+
+    @staticmethod
+    def _worker_main(log_queue, target, args):
+        """Route the worker's log records to the supervisor and run the target"""
+        root = logging.getLogger()
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+        root.addHandler(QueueHandler(log_queue))
+        root.setLevel(logging.DEBUG)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        target(*args)
+
+    def _spawn(self, index):
+        """Start (or restart) the worker with the given index"""
+        process = multiprocessing.Process(target=self._worker_main, args=(self._log_queue, self.target, self.args),
+                                          name=f"worker-{index}")
+        process.start()
+        self.processes[index] = (process, time.monotonic())
+        logging.info(f"Started worker-{index} (pid {process.pid})")
+
+    def stop(self, *_):
+        """Stop supervising and terminate all workers"""
+        self.is_running = False
+
+    def _terminate_workers(self):
+        for process, _ in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+        for process, _ in self.processes.values():
+            process.join(timeout=5)
+
+    def run(self):
+        """
+        Start the workers and keep them running until stopped. A worker exiting with an
+        error is restarted; a worker exiting cleanly (e.g. after an admin shutdown)
+        stops the whole pool.
+        """
+        file_handler = RotatingFileHandler(self.log_file, maxBytes=5 * 1024 * 1024, backupCount=5)
+        file_handler.setFormatter(logging.Formatter('%(asctime)s - %(processName)s - %(levelname)s - %(message)s'))
+        logging.basicConfig(handlers=[file_handler], level=logging.DEBUG)
+        listener = QueueListener(self._log_queue, file_handler)
+        listener.start()
+        signal.signal(signal.SIGTERM, self.stop)
+        self.is_running = True
+        try:
+            for index in range(self.workers):
+                self._spawn(index)
+            while self.is_running:
+                sentinels = {process.sentinel: index for index, (process, _) in self.processes.items()}
+                for sentinel in wait(list(sentinels), timeout=1.0):
+                    index = sentinels[sentinel]
+                    process, started = self.processes[index]
+                    process.join()
+                    if process.exitcode == 0:
+                        logging.info(f"worker-{index} exited cleanly - stopping all workers")
+                        self.is_running = False
+                        break
+                    logging.error(f"worker-{index} (pid {process.pid}) died with exit code {process.exitcode}")
+                    if time.monotonic() - started < self.restart_delay:
+                        time.sleep(self.restart_delay)
+                    self._spawn(index)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._terminate_workers()
+            logging.info("All workers stopped")
+            listener.stop()
@@ -0,0 +1,33 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db_manager import DbManager  # noqa: E402
+
+# (backend, shards) combinations every storage test runs against
+BACKENDS = [("json", 1), ("log", 1), ("mmap", 1), ("sqlite", 1), ("json", 3), ("log", 3), ("sqlite", 3)]
+
+
+@pytest.fixture(params=BACKENDS, ids=[f"{backend}-{shards}" for backend, shards in BACKENDS])
+def db(request, tmp_path):
+    """DbManager configured with a fresh database of each backend"""
+    backend, shards = request.param
+    path = tmp_path / "users" if shards > 1 else tmp_path / f"users.{backend}"
+    DbManager.configure(backend, path=str(path), shards=shards)
+    yield DbManager
+    DbManager.storage.close()
+    DbManager.sessions.close()
+    DbManager.storage = DbManager.sessions = None
+
+
+@pytest.fixture
+def json_db(tmp_path):
+    """DbManager configured with a fresh JSON database"""
+    DbManager.configure("json", path=str(tmp_path / "users.json"))
+    yield DbManager
+    DbManager.storage.close()
+    DbManager.sessions.close()
+    DbManager.storage = DbManager.sessions = None
@@ -0,0 +1,54 @@
+import pytest
+
+from bloom_filter import CountingBloomFilter
+
+
+def test_added_keys_are_always_found():
+    bloom = CountingBloomFilter(1000)
+    keys = [f"user{index}" for index in range(1000)]
+    for key in keys:
+        bloom.add(key)
+    assert all(key in bloom for key in keys)
+    assert len(bloom) == 1000
+
+
+def test_false_positive_rate_at_capacity():
+    bloom = CountingBloomFilter(1000, error_rate=0.01)
+    for index in range(1000):
+        bloom.add(f"user{index}")
+    false_positives = sum(f"other{index}" in bloom for index in range(10000))
+    assert false_positives < 300
+
+
+def test_discarded_key_is_gone_and_others_stay():
+    bloom = CountingBloomFilter(100)
+    for key in ("alice", "bob", "carol"):
+        bloom.add(key)
+    bloom.discard("bob")
+    assert "bob" not in bloom
+    assert "alice" in bloom and "carol" in bloom
+    assert len(bloom) == 2
+
+
+def test_key_added_twice_survives_one_discard():
+    bloom = CountingBloomFilter(100)
+    bloom.add("alice")
+    bloom.add("alice")
+    bloom.discard("alice")
+    assert "alice" in bloom
+
+
+def test_saturated_counters_never_cause_false_negatives():
+    bloom = CountingBloomFilter(1, error_rate=0.5)
+    keys = [f"user{index}" for index in range(2000)]
+    for key in keys:
+        bloom.add(key)
+    for key in keys[:1000]:
+        bloom.discard(key)
+    assert all(key in bloom for key in keys[1000:])
+
+
+@pytest.mark.parametrize("capacity, error_rate", [(0, 0.01), (10, 0), (10, 1)])
+def test_invalid_parameters_are_refused(capacity, error_rate):
+    with pytest.raises(ValueError):
+        CountingBloomFilter(capacity, error_rate)
@@ -0,0 +1,86 @@
+import socket
+import zlib
+
+import pytest
+
+from communication import COMPRESSED_FLAG, LENGTH_MASK, CommunicationProtocol, FrameTooLarge
+
+
+@pytest.fixture
+def protocol():
+    return CommunicationProtocol(None, max_frame_size=1024)
+
+
+def frame(protocol, message, compress=False):
+    """Encode a message into the (header, body) pair _decode_frame receives"""
+    body = protocol.codec.encode(protocol.format_message(message))
+    if compress:
+        body = zlib.compress(body)
+        return len(body) | COMPRESSED_FLAG, body
+    return len(body), body
+
+
+def test_decode_plain_frame(protocol):
+    assert protocol._decode_frame(*frame(protocol, "hello"))["message"] == "hello"
+
+
+def test_decode_compressed_frame(protocol):
+    header, body = frame(protocol, "hello " * 100, compress=True)
+    assert protocol._decode_frame(header, body)["message"] == "hello " * 100
+
+
+def test_compressed_frame_at_limit_is_accepted(protocol):
+    padding = 1024 - len(protocol.codec.encode(protocol.format_message("")))
+    header, body = frame(protocol, "x" * padding, compress=True)
+    assert len(protocol._decode_frame(header, body)["message"]) == padding
+
+
+def test_compressed_frame_expanding_beyond_limit_is_refused(protocol):
+    header, body = frame(protocol, "x" * 2048, compress=True)
+    assert header & LENGTH_MASK < 1024
+    with pytest.raises(FrameTooLarge):
+        protocol._decode_frame(header, body)
+
+
+def test_decompression_bomb_is_refused_without_inflating_it():
+    protocol = CommunicationProtocol(None, max_frame_size=4096)
+    body = zlib.compress(b"\0" * (64 * 1024 * 1024), 9)
+    with pytest.raises(FrameTooLarge):
+        protocol._decode_frame(len(body) | COMPRESSED_FLAG, body)
+
+
+def test_corrupt_compressed_frame_is_refused(protocol):
+    with pytest.raises(ValueError):
+        protocol._decode_frame(4 | COMPRESSED_FLAG, b"junk")
+
+
+def test_frame_too_large_is_a_value_error():
+    assert issubclass(FrameTooLarge, ValueError)
+
+
+@pytest.mark.parametrize("length", [1, 1024])
+def test_lengths_up_to_limit_are_accepted(protocol, length):
+    protocol._check_length(length)
+
+
+def test_length_above_limit_is_refused(protocol):
+    with pytest.raises(FrameTooLarge):
+        protocol._check_length(1025)
+
+
+def test_empty_frame_is_refused(protocol):
+    with pytest.raises(ValueError):
+        protocol._check_length(0)
+
+
+def test_oversized_header_is_refused_before_reading_the_body():
+    server, client = socket.socketpair()
+    try:
+        protocol = CommunicationProtocol(server, max_frame_size=1024)
+        client.sendall((0x7fffff00).to_bytes(4, "big"))
+        with pytest.raises(FrameTooLarge):
+            protocol.receive()
+        assert len(protocol._buffer) <= 1024 * 1024
+    finally:
+        server.close()
+        client.close()
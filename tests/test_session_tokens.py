@@ -0,0 +1,76 @@
+import pytest
+
+import session_tokens
+from session_tokens import SessionTokens
+
+SECRET = b"s" * 32
+
+
+@pytest.fixture
+def tokens(json_db):
+    SessionTokens.configure(SECRET, ttl=60)
+    yield SessionTokens
+    SessionTokens.configure()
+
+
+def test_issued_token_resumes_session(tokens):
+    token = tokens.issue("alice")
+    assert tokens.validate(token) == ("alice", "main")
+    tokens.remember(token, "user management")
+    assert tokens.validate(token) == ("alice", "user management")
+
+
+def test_token_from_another_process_resumes_at_main_menu(tokens):
+    token = tokens.issue("alice")
+    tokens.remember(token, "user management")
+    # a process sharing the secret, without this one's session table
+    tokens.configure(SECRET, ttl=60)
+    assert tokens.validate(token) == ("alice", "main")
+
+
+def test_expired_token_is_refused(tokens, monkeypatch):
+    token = tokens.issue("alice")
+    now = session_tokens.time.time()
+    monkeypatch.setattr(session_tokens.time, "time", lambda: now + 61)
+    with pytest.raises(ValueError, match="expired"):
+        tokens.validate(token)
+
+
+@pytest.mark.parametrize("tamper", [
+    lambda token: token + "x",
+    lambda token: token.replace(".", ""),
+    lambda token: "e30." + token.split(".")[1],
+])
+def test_tampered_token_is_refused(tokens, tamper):
+    with pytest.raises(ValueError):
+        tokens.validate(tamper(tokens.issue("alice")))
+
+
+def test_token_signed_with_another_secret_is_refused(tokens):
+    token = tokens.issue("alice")
+    tokens.configure(b"t" * 32, ttl=60)
+    with pytest.raises(ValueError, match="signature"):
+        tokens.validate(token)
+
+
+def test_revoked_token_is_refused(tokens):
+    token = tokens.issue("alice")
+    tokens.revoke(token)
+    with pytest.raises(ValueError, match="logged out"):
+        tokens.validate(token)
+
+
+def test_revocation_is_seen_by_other_processes(tokens, json_db):
+    token = tokens.issue("alice")
+    tokens.revoke(token)
+    # another worker sharing the database knows nothing of the session but the revocation
+    tokens.configure(SECRET, ttl=60)
+    with pytest.raises(ValueError, match="logged out"):
+        tokens.validate(token)
+    assert json_db.session_revoked(tokens._claims(token)["sid"])
+
+
+def test_revoking_leaves_other_sessions_alone(tokens):
+    first, second = tokens.issue("alice"), tokens.issue("alice")
+    tokens.revoke(first)
+    assert tokens.validate(second) == ("alice", "main")
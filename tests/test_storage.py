@@ -0,0 +1,131 @@
+import pytest
+
+from storage import VersionConflict
+
+
+def user(email, role="user"):
+    return {"password_hash": "hash", "email": email, "role": role}
+
+
+def test_insert_if_absent_only_inserts_once(db):
+    assert db.insert_if_absent("alice", user("alice@example.com"))
+    assert not db.insert_if_absent("alice", user("other@example.com"))
+    assert db.get("alice")["alice"]["email"] == "alice@example.com"
+    assert db.get_version("alice") == 1
+
+
+def test_save_many_only_new_skips_existing_records(db):
+    db.save("alice", user("alice@example.com"))
+    saved = db.save_many({"alice": user("new@example.com"), "bob": user("bob@example.com")}, expected_version=0)
+    assert saved == ["bob"]
+    assert db.get("alice")["alice"]["email"] == "alice@example.com"
+    assert db.get("bob")["bob"]["email"] == "bob@example.com"
+
+
+def test_save_many_overwrites_without_expected_version(db):
+    db.save("alice", user("alice@example.com"))
+    assert sorted(db.save_many({"alice": user("new@example.com"), "bob": user("bob@example.com")})) == ["alice", "bob"]
+    assert db.get("alice")["alice"]["email"] == "new@example.com"
+    assert db.get_version("alice") == 2
+
+
+def test_save_increments_version(db):
+    assert db.save("alice", user("alice@example.com")) == 1
+    assert db.save("alice", user("alice@example.com"), expected_version=1) == 2
+    assert db.get_version("alice") == 2
+    assert db.get_version("nobody") == 0
+
+
+def test_save_at_wrong_version_conflicts(db):
+    db.save("alice", user("alice@example.com"))
+    db.save("alice", user("new@example.com"))
+    with pytest.raises(VersionConflict):
+        db.save("alice", user("stale@example.com"), expected_version=1)
+    with pytest.raises(VersionConflict):
+        db.save("alice", user("stale@example.com"), expected_version=0)
+    with pytest.raises(VersionConflict):
+        db.save("bob", user("bob@example.com"), expected_version=1)
+    assert db.get("alice")["alice"]["email"] == "new@example.com"
+    assert db.get_version("bob") == 0
+
+
+def test_delete_at_wrong_version_conflicts(db):
+    db.save("alice", user("alice@example.com"))
+    db.save("alice", user("new@example.com"))
+    with pytest.raises(VersionConflict):
+        db.delete("alice", expected_version=1)
+    assert "alice" in db.keys()
+    db.delete("alice", expected_version=2)
+    assert "alice" not in db.keys()
+
+
+def test_delete_if_present_and_delete_many(db):
+    db.save_many({name: user(f"{name}@example.com") for name in ("alice", "bob", "carol")})
+    assert db.delete_if_present("alice")
+    assert not db.delete_if_present("alice")
+    assert sorted(db.delete_many(["bob", "carol", "dave"])) == ["bob", "carol"]
+    assert db.keys() == []
+
+
+def test_scan_returns_pages_in_key_order(db):
+    names = [f"user{index:02}" for index in range(25)]
+    db.save_many({name: user(f"{name}@example.com") for name in reversed(names)})
+    pages, after = [], None
+    while True:
+        page = db.scan(after, 10)
+        if not page:
+            break
+        assert len(page) <= 10
+        pages.append(list(page))
+        after = pages[-1][-1]
+    assert [len(page) for page in pages] == [10, 10, 5]
+    assert [name for page in pages for name in page] == names
+
+
+def test_scan_sees_changes_between_pages(db):
+    db.save_many({name: user(f"{name}@example.com") for name in ("a", "c", "e")})
+    assert list(db.scan(None, 2)) == ["a", "c"]
+    db.save("b", user("b@example.com"))
+    db.save("d", user("d@example.com"))
+    assert list(db.scan("c", 2)) == ["d", "e"]
+
+
+def test_scan_rejects_invalid_limit(db):
+    with pytest.raises(ValueError):
+        db.scan(None, 0)
+
+
+def test_find_by_value_prefix_and_filters(db):
+    db.save_many({
+        "alice": user("alice@example.com", "admin"),
+        "bob": user("bob@example.com"),
+        "bobby": user("bobby@example.org"),
+        "carol": user("carol@example.com"),
+    })
+    assert list(db.find("email", value="bob@example.com")) == ["bob"]
+    assert sorted(db.find("email", prefix="bob")) == ["bob", "bobby"]
+    assert list(db.find("role", value="admin")) == ["alice"]
+    assert sorted(db.find("email", prefix="", filters={"role": "user"})) == ["bob", "bobby", "carol"]
+    assert db.find("email", value="nobody@example.com") == {}
+
+
+def test_find_follows_updates_and_deletes(db):
+    db.save("alice", user("alice@example.com"))
+    db.save("alice", user("alice@example.org", "admin"))
+    assert db.find("email", value="alice@example.com") == {}
+    assert list(db.find("role", value="admin")) == ["alice"]
+    db.delete("alice")
+    assert db.find("role", value="admin") == {}
+
+
+def test_find_limit(db):
+    db.save_many({f"user{index}": user(f"user{index}@example.com") for index in range(10)})
+    assert len(db.find("role", value="user", limit=3)) == 3
+    assert len(db.find("role", value="user")) == 10
+
+
+def test_find_rejects_unindexed_fields(db):
+    with pytest.raises(ValueError):
+        db.find("password_hash", value="hash")
+    with pytest.raises(ValueError):
+        db.find("email")
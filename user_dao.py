@@ -1,62 +1,239 @@
-import hashlib
 import logging
+import os
+import threading
+import time
 
-from db_manager import DbManager
+from bloom_filter import CountingBloomFilter
+from db_manager import DbManager, VersionConflict
+from password_hasher import PasswordHasher
 
 
 class UserDAO:
+    # starting the worker processes takes about 70 ms, the time of two or three scrypt hashes at the
+    # default cost, so with two or more CPUs the pool already pays off for a handful of passwords
+    parallel_hashing_threshold = 8
+    # minimum seconds between rebuilds of the username filter after the database changed
+    username_filter_refresh = 1.0
+    username_filter_error_rate = 0.01
+    # (filter of all usernames, database stamp it is current at or None if unknown)
+    _usernames = (None, None)
+    _usernames_built = None
+    _usernames_lock = threading.Lock()
+    # users saved while a rebuild reads the database, added to the new filter
+    _usernames_saved = None
+    _usernames_rebuild_lock = threading.Lock()
 
     @staticmethod
     def hash_password(password):
         """
-        Return a hashed version of the password.
+        Return a salted hash of the password, computed on the password hashing pool.
 
         Args:
             password (str): Password to hash
 
         Returns:
-            str: Hashed password
+            str: Hashed password, including its algorithm, cost and salt
 
         Raises:
             TypeError: If password is not a string
             ValueError: If password is empty
+            HasherBusy: If too many passwords are already being hashed
         """
         if not isinstance(password, str):
             raise TypeError("Password must be a string")
         if not password:
             raise ValueError("Password cannot be empty")
         try:
-            return hashlib.sha256(password.encode()).hexdigest()
-        except Exception as e:
+            return PasswordHasher.hash(password)
+        except (TypeError, ValueError) as e:
             logging.error(f"Password hashing failed: {e}")
             raise ValueError("Failed to hash password") from e
 
     @staticmethod
-    def user_exists(username):
+    def verify_password(password, password_hash):
         """
-        Check if a user exists in the database.
+        Check a password against a stored hash.
 
         Args:
-            username (str): Username to check
+            password (str): Password to check
+            password_hash (str): Hash stored for the user, of any supported algorithm
 
         Returns:
-            bool: True if user exists, False otherwise
+            bool: True if the password matches
 
         Raises:
-            TypeError: If username is not a string
-            ValueError: If username is empty
+            TypeError: If password is not a string
+            ValueError: If the stored hash is corrupted
+            HasherBusy: If too many passwords are already being hashed
         """
-        if not isinstance(username, str):
-            raise TypeError("Username must be a string")
-        if not username.strip():
-            raise ValueError("Username cannot be empty")
+        if not isinstance(password, str):
+            raise TypeError("Password must be a string")
+        if not isinstance(password_hash, str):
+            raise ValueError("Invalid password hash")
+        return PasswordHasher.verify(password, password_hash)
+
+    @staticmethod
+    def hash_passwords(passwords, workers=None):
+        """
+        Hash many passwords, spreading the work over a pool of processes.
+
+        Args:
+            passwords (list): Passwords to hash
+            workers (int, optional): Number of processes, defaults to the number of CPUs
+
+        Returns:
+            list: Hashed passwords in the order of the input
+
+        Raises:
+            TypeError: If a password is not a string
+            ValueError: If a password is empty
+        """
+        for password in passwords:
+            if not isinstance(password, str):
+                raise TypeError("Password must be a string")
+            if not password:
+                raise ValueError("Password cannot be empty")
+        if len(passwords) < UserDAO.parallel_hashing_threshold or (workers or os.cpu_count()) == 1:
+            workers = 1
+        return PasswordHasher.hash_many(passwords, workers)
+
+    @classmethod
+    def build_username_filter(cls):
+        """
+        Rebuild the filter of existing usernames from the database. Only the keys
+        are read, not the records.
+
+        Raises:
+            OSError: If database access fails
+        """
+        with cls._usernames_rebuild_lock:
+            with cls._usernames_lock:
+                cls._usernames_saved = []
+            try:
+                # taken before the keys are read, so a change made while reading them leaves the filter stale
+                stamp = DbManager.stamp()
+                usernames = DbManager.keys()
+                username_filter = CountingBloomFilter(max(2 * len(usernames), 1024), cls.username_filter_error_rate)
+                for username in usernames:
+                    username_filter.add(username)
+            except BaseException:
+                with cls._usernames_lock:
+                    cls._usernames_saved = None
+                raise
+            with cls._usernames_lock:
+                for username in cls._usernames_saved:
+                    username_filter.add(username)
+                cls._usernames_saved = None
+                # this process's own changes since the stamp are in the filter, by the keys or as saved users
+                cls._usernames = (username_filter, DbManager.advance_stamp(stamp))
+                cls._usernames_built = time.monotonic()
+        logging.info(f"Built username filter of {len(usernames)} users")
+
+    @classmethod
+    def _rebuild_username_filter(cls):
         try:
-            return DbManager.get(username)[username] is not None
-        except KeyError:
-            return False
-        except (Exception, ValueError) as e:
-            logging.error(f"Error checking user existence: {e}")
-            raise
+            cls.build_username_filter()
+        except OSError as e:
+            logging.error(f"Failed to build username filter: {e}")
+
+    @classmethod
+    def might_exist(cls, username):
+        """
+        Check the username filter for a user, without reading the database unless
+        the filter can't be trusted.
+
+        A user missing from the filter definitely doesn't exist as long as the
+        filter is current. Saves and deletes made through this class update the
+        filter and keep it current, but a change by another process makes it stale
+        until it is rebuilt; meanwhile users missing from it are reported as
+        possibly existing. Rebuilds run on a background thread, at most once per
+        username_filter_refresh seconds.
+
+        Args:
+            username (str): Username to check
+
+        Returns:
+            bool: False if the user definitely doesn't exist, True if it may
+        """
+        username_filter, stamp = cls._usernames
+        if username_filter is not None:
+            if username in username_filter:
+                return True
+            if stamp is not None and stamp == DbManager.stamp():
+                return False
+        with cls._usernames_lock:
+            built = cls._usernames_built
+            if built is not None and time.monotonic() - built < cls.username_filter_refresh:
+                return True
+            # claimed by this thread, so concurrent lookups don't start a rebuild as well
+            cls._usernames_built = time.monotonic()
+        threading.Thread(target=cls._rebuild_username_filter, name="username-filter", daemon=True).start()
+        return True
+
+    @classmethod
+    def _filter_added(cls, usernames):
+        """
+        Add saved users to the username filter. The filter stays current if the save
+        was the only change since it last was.
+        """
+        with cls._usernames_lock:
+            if cls._usernames_saved is not None:
+                cls._usernames_saved.extend(usernames)
+            username_filter, stamp = cls._usernames
+            if username_filter is None:
+                return
+            for username in usernames:
+                username_filter.add(username)
+            if len(username_filter) > username_filter.capacity:
+                # over capacity the false positive rate climbs, so rebuild it at a larger size
+                cls._usernames = (username_filter, None)
+                cls._usernames_built = None
+            elif stamp is not None:
+                cls._usernames = (username_filter, DbManager.advance_stamp(stamp))
+
+    @classmethod
+    def _filter_removed(cls, username_filter, usernames):
+        """
+        Remove deleted users from the username filter, if it is still the one taken
+        before the delete. A filter built later may not hold the users, and removing
+        a user that isn't in it could hide others. The filter stays current either
+        way, since a user left in it only costs a database read.
+        """
+        with cls._usernames_lock:
+            if cls._usernames[0] is username_filter and username_filter is not None:
+                for username in usernames:
+                    username_filter.discard(username)
+            current, stamp = cls._usernames
+            if stamp is not None:
+                cls._usernames = (current, DbManager.advance_stamp(stamp))
+
+    @staticmethod
+    def get_usernames():
+        """
+        Retrieve the usernames of all users, without reading their records.
+
+        Returns:
+            list: Usernames, in no particular order
+
+        Raises:
+            OSError: If database access fails
+        """
+        return DbManager.keys()
+
+    @staticmethod
+    def get_user_version(username):
+        """
+        Retrieve the version of a stored user, for a later conditional save.
+
+        Args:
+            username (str): Username to look up
+
+        Returns:
+            int: The user's version, 0 if the user doesn't exist
+        """
+        if isinstance(username, str) and not UserDAO.might_exist(username):
+            return 0
+        return DbManager.get_version(username)
 
     @staticmethod
     def get_user(username=None):
@@ -82,24 +259,21 @@ class UserDAO:
                     raise TypeError("Username must be a string")
                 if not username.strip():
                     raise ValueError("Username cannot be empty")
+                if not UserDAO.might_exist(username):
+                    raise KeyError(f"No record found for {username}")
                 return DbManager.get(username)
         except (ValueError, KeyError) as e:
             logging.error(f"Failed to retrieve user data: {e}")
             raise
 
     @staticmethod
-    def save_user(user_data):
+    def _record(user_data):
         """
-        Save user data.
-
-        Args:
-            user_data (dict): User data to save containing username, password_hash,
-                            email, and role
+        Split user data into the username and the record stored for it.
 
         Raises:
             TypeError: If user_data is not a dictionary
             ValueError: If required fields are missing or invalid
-            OSError: If database operation fails
         """
         if not isinstance(user_data, dict):
             raise TypeError("User data must be a dictionary")
@@ -112,36 +286,209 @@ class UserDAO:
         username = user_data.get("username")
         if not isinstance(username, str) or not username.strip():
             raise ValueError("Invalid username")
+        record = {"password_hash": user_data.get("password_hash"),
+                  "email": user_data.get("email"),
+                  "role": user_data.get("role")}
+        # kept when given, so rewriting an account (e.g. to upgrade its password hash) doesn't drop its mail
+        if user_data.get("inbox"):
+            record["inbox"] = user_data["inbox"]
+        return username, record
+
+    @staticmethod
+    def get_users_page(after=None, limit=100):
+        """
+        Retrieve a page of users in username order.
+
+        Args:
+            after (str, optional): Return only users listed after this username
+            limit (int): Maximum number of users to return
+
+        Returns:
+            dict: User data keyed by username
+
+        Raises:
+            ValueError: If after or limit is invalid
+            OSError: If database access fails
+        """
+        try:
+            return DbManager.scan(after, limit)
+        except ValueError as e:
+            logging.error(f"Failed to retrieve user data: {e}")
+            raise
+
+    @staticmethod
+    def find_users(role=None, email=None, email_prefix=None, limit=None):
+        """
+        Retrieve the users matching all given criteria. The email index is used when an
+        email or prefix is given and the role index otherwise, so only matching users
+        are read.
+
+        Args:
+            role (str, optional): Role the users must have
+            email (str, optional): Email the users must have
+            email_prefix (str, optional): Prefix the users' email must start with
+            limit (int, optional): Maximum number of users to return
+
+        Returns:
+            dict: User data keyed by username, in username order
+
+        Raises:
+            ValueError: If no criteria are given or they are invalid
+            OSError: If database access fails
+        """
+        if email is not None or email_prefix is not None:
+            filters = {"role": role} if role is not None else None
+            users = DbManager.find("email", value=email, prefix=None if email is not None else email_prefix,
+                                   filters=filters, limit=limit)
+        elif role is not None:
+            users = DbManager.find("role", value=role, limit=limit)
+        else:
+            raise ValueError("At least one of role, email or email prefix is required")
+        return {username: users[username] for username in sorted(users)}
+
+    @staticmethod
+    def email_registered(email):
+        """
+        Check if an account with the email exists, using the email index.
+
+        Args:
+            email (str): Email to check
+
+        Returns:
+            bool: True if the email is taken, False otherwise
+        """
+        return bool(DbManager.find("email", value=email, limit=1))
+
+    @staticmethod
+    def save_user(user_data, expected_version=None):
+        """
+        Save user data.
+
+        Args:
+            user_data (dict): User data to save containing username, password_hash,
+                            email, and role
+            expected_version (int, optional): Version the stored user must be at, 0 to
+                only create a new user
+
+        Returns:
+            int: The user's new version
+
+        Raises:
+            TypeError: If user_data is not a dictionary
+            ValueError: If required fields are missing or invalid
+            VersionConflict: If the stored user isn't at expected_version
+            OSError: If database operation fails
+        """
+        username, data = UserDAO._record(user_data)
+        try:
+            version = DbManager.save(username, data, expected_version)
+        except VersionConflict:
+            raise
+        except (ValueError, TypeError) as e:
+            logging.error(f"Failed to save user data: {e}")
+            raise
+        # a rewritten user is in the filter already, and adding it again would only inflate its count
+        UserDAO._filter_added([username] if version == 1 else [])
+        return version
+
+    @staticmethod
+    def add_user(user_data):
+        """
+        Save a new user, unless the username is taken, in a single database operation.
 
+        Args:
+            user_data (dict): User data to save, as accepted by save_user
+
+        Returns:
+            bool: True if the user was added, False if the username was already taken
+
+        Raises:
+            TypeError: If user_data is not a dictionary
+            ValueError: If required fields are missing or invalid
+            OSError: If database operation fails
+        """
+        username, data = UserDAO._record(user_data)
         try:
-            data = {"password_hash": user_data.get("password_hash"),
-                    "email": user_data.get("email"),
-                    "role": user_data.get("role")}
-            DbManager.save(username, data)
+            added = DbManager.insert_if_absent(username, data)
         except (ValueError, TypeError) as e:
             logging.error(f"Failed to save user data: {e}")
             raise
+        if added:
+            UserDAO._filter_added([username])
+        return added
 
     @staticmethod
-    def delete_user(username):
+    def save_users(users, only_new=False):
         """
-        Delete a user.
+        Save many users in a single database write.
+
+        Args:
+            users (iterable): User data dictionaries, as accepted by save_user
+            only_new (bool): Skip users whose username is taken when the write is made,
+                instead of overwriting them
+
+        Returns:
+            list: The usernames that were saved
+
+        Raises:
+            TypeError: If an entry is not a dictionary
+            ValueError: If required fields are missing or invalid
+            OSError: If database operation fails
+        """
+        records = dict(UserDAO._record(user_data) for user_data in users)
+        try:
+            saved = DbManager.save_many(records, expected_version=0 if only_new else None)
+        except (ValueError, TypeError) as e:
+            logging.error(f"Failed to save user data: {e}")
+            raise
+        except OSError:
+            # some shards may have been written, so the filter has to cover every user that may have been saved
+            UserDAO._filter_added(records)
+            raise
+        UserDAO._filter_added(saved)
+        return saved
+
+    @staticmethod
+    def remove_user(username):
+        """
+        Delete a user if it exists, in a single database operation.
 
         Args:
             username (str): Username to delete
 
+        Returns:
+            bool: True if the user was deleted, False if it didn't exist
+
         Raises:
             TypeError: If username is not a string
             ValueError: If username is empty
-            KeyError: If user doesn't exist
             OSError: If database operation fails
         """
         if not isinstance(username, str):
             raise TypeError("Username must be a string")
         if not username.strip():
             raise ValueError("Username cannot be empty")
-        try:
-            DbManager.delete(username)
-        except (KeyError, TypeError, ValueError) as e:
-            logging.error(f"Failed to delete user {e}")
-            raise
+        username_filter = UserDAO._usernames[0]
+        deleted = DbManager.delete_if_present(username)
+        if deleted:
+            UserDAO._filter_removed(username_filter, [username])
+        return deleted
+
+    @staticmethod
+    def delete_users(usernames):
+        """
+        Delete many users in a single database write. Unknown usernames are skipped.
+
+        Args:
+            usernames (iterable): Usernames to delete
+
+        Returns:
+            list: The usernames that were deleted
+
+        Raises:
+            OSError: If database operation fails
+        """
+        username_filter = UserDAO._usernames[0]
+        deleted = DbManager.delete_many(usernames)
+        UserDAO._filter_removed(username_filter, deleted)
+        return deleted
@@ -1,20 +1,88 @@
+import base64
+import binascii
+import csv
+import fnmatch
+import json
 import logging
+import os
 from datetime import datetime
+from db_manager import VersionConflict
+from password_hasher import PasswordHasher
+from session_tokens import SessionTokens
 from user_dao import UserDAO
 
 
+class Inbox:
+    """
+    Handle on a user's mailbox. The messages are only read from the database when
+    they are first asked for, so a logged-in user doesn't carry them around.
+    """
+
+    __slots__ = ("username", "_messages")
+
+    def __init__(self, username, messages=None):
+        self.username = username
+        self._messages = messages
+
+    def messages(self):
+        """
+        Return the messages, reading them from the database on first use.
+
+        Returns:
+            dict: The stored inbox, empty if the user has no messages
+
+        Raises:
+            KeyError: If the user doesn't exist
+            OSError: If database access fails
+        """
+        if self._messages is None:
+            self._messages = UserDAO.get_user(self.username)[self.username].get("inbox") or {}
+        return self._messages
+
+    def release(self):
+        """Drop the loaded messages, so they are read again on next use"""
+        self._messages = None
+
+
 class User:
+    # no per-instance __dict__: a logged-in session holds one User for as long as it lasts
+    __slots__ = ("username", "password_hash", "email", "role", "is_logged_in", "session_token", "_inbox")
+
     def __init__(self, username, password_hash, email, role="user", inbox=None):
         self.username = username
         self.password_hash = password_hash
         self.email = email
         self.role = role
-        self.inbox = inbox if inbox else None
+        self._inbox = Inbox(username, inbox) if inbox else None
         self.is_logged_in = False
+        self.session_token = None
+
+    @classmethod
+    def from_record(cls, username, record):
+        """
+        Build a user from a stored record. Fields other than the account details,
+        such as the inbox, are left in the database until they are asked for.
+
+        Raises:
+            TypeError: If the record lacks the password hash or email
+        """
+        try:
+            return cls(username, record["password_hash"], record["email"], record.get("role", "user"))
+        except KeyError as e:
+            raise TypeError(f"User record lacks {e}") from e
+
+    @property
+    def inbox(self):
+        """Lazily loaded handle on the user's mailbox"""
+        if self._inbox is None:
+            self._inbox = Inbox(self.username)
+        return self._inbox
 
     @classmethod
     def log_in(cls, username, password):
         """Authenticate and return a user instance if credentials are valid.
+        A password stored with an outdated hashing algorithm or cost is re-hashed.
+        The user gets a session token that can resume the login on another connection.
 
         Args:
         username (str): Username
@@ -28,11 +96,14 @@ class User:
             ValueError: If password is empty or incorrect.
             KeyError: If user with provided username doesn't exist.
             AttributeError: If user data in database is corrupted or in wrong format.
+            HasherBusy: If too many passwords are already being checked.
         """
         if not isinstance(username, str):
             raise TypeError("Username must be a string")
         if not isinstance(password, str):
             raise TypeError("Password must be a string")
+        # read before the record, so an upgrade based on an outdated record fails its version check
+        version = UserDAO.get_user_version(username)
         user_data = UserDAO.get_user(username)
         if not user_data:
             raise KeyError(f"User {username} not found")
@@ -40,10 +111,13 @@ class User:
             stored_data = user_data[username]
             if stored_data is None:
                 raise KeyError(f"User {username} not found")
-            if stored_data['password_hash'] != UserDAO.hash_password(password):
+            if not UserDAO.verify_password(password, stored_data['password_hash']):
                 raise ValueError("Invalid password")
-            user = cls(username=username, **stored_data)
+            if PasswordHasher.needs_rehash(stored_data['password_hash']):
+                cls._upgrade_password_hash(username, stored_data, password, version)
+            user = cls.from_record(username, stored_data)
             user.is_logged_in = True
+            user.session_token = SessionTokens.issue(username)
             return user
         except KeyError as e:
             logging.error(f"User lookup failed: {e}")
@@ -52,6 +126,71 @@ class User:
             logging.error(f"Corrupted user data: {e}")
             raise ValueError("Invalid user data format")
 
+    @classmethod
+    def resume(cls, token):
+        """Log a user in again with the session token issued at an earlier login.
+
+        Args:
+            token (str): Session token
+
+        Returns:
+            tuple: The logged-in User and the name of the menu the session was in
+
+        Raises:
+            ValueError: If the token is invalid, expired or was logged out
+            KeyError: If the user no longer exists
+        """
+        username, menu = SessionTokens.validate(token)
+        stored_data = UserDAO.get_user(username)[username]
+        try:
+            user = cls.from_record(username, stored_data)
+        except TypeError as e:
+            logging.error(f"Corrupted user data: {e}")
+            raise ValueError("Invalid user data format")
+        user.is_logged_in = True
+        user.session_token = token
+        return user, menu
+
+    def log_out(self):
+        """
+        End the user's session, so its token can't be used to resume it.
+
+        Raises:
+            OSError: If the end of the session can't be recorded
+        """
+        if self.session_token is not None:
+            SessionTokens.revoke(self.session_token)
+            self.session_token = None
+        self.is_logged_in = False
+
+    @staticmethod
+    def _upgrade_password_hash(username, stored_data, password, version):
+        """Re-hash a password with the current algorithm and cost, unless the user was changed meanwhile"""
+        try:
+            UserDAO.save_user({**stored_data, "username": username, "password_hash": UserDAO.hash_password(password)},
+                              expected_version=version)
+            logging.info(f"Upgraded the password hash of user {username}")
+        except VersionConflict:
+            logging.info(f"User {username} changed during login - password hash not upgraded")
+        except OSError as e:
+            logging.error(f"Failed to upgrade the password hash of user {username}: {e}")
+
+    @staticmethod
+    def _validate(username, password, email, role):
+        """
+        Check new account details.
+
+        Raises:
+            ValueError: If any parameter is invalid
+            TypeError: If parameters are of wrong type
+        """
+        if not all(isinstance(param, str) for param in [username, password, email, role]):
+            raise TypeError("All parameters must be strings")
+        if not all(param.strip() for param in [username, password, email]):
+            raise ValueError("Parameters cannot be empty")
+        if role not in ["user", "admin"]:
+            raise ValueError("Invalid role")
+
     @classmethod
     def register(cls, username, password, email, role="user"):
         """
@@ -67,26 +206,22 @@ class User:
         bool: True if registration successful
 
     Raises:
-        ValueError: If any parameter is invalid
+        ValueError: If any parameter is invalid or the user already exists
         TypeError: If parameters are of wrong type
     """
-        if not all(isinstance(param, str) for param in [username, password, email, role]):
-            raise TypeError("All parameters must be strings")
-        if not all(param.strip() for param in [username, password, email]):
-            raise ValueError("Parameters cannot be empty")
-        if role not in ["user", "admin"]:
-            raise ValueError("Invalid role")
-
+        cls._validate(username, password, email, role)
         try:
-            if UserDAO.user_exists(username):
-                raise ValueError(f"User {username} already exists")
+            if UserDAO.email_registered(email):
+                raise ValueError(f"Email {email} is already registered")
             user_data = {
                 "username": username,
                 "password_hash": UserDAO.hash_password(password),
                 "email": email,
                 "role": role
             }
-            UserDAO.save_user(user_data)
+            # checks the username is free and creates the account in one step, so no check can go stale
+            if not UserDAO.add_user(user_data):
+                raise ValueError(f"User {username} already exists")
             return True
         except (TypeError, ValueError, OSError) as e:
             logging.error(f"User registration failed: {e}")
@@ -111,14 +246,151 @@ class User:
             raise ValueError("Invalid username")
 
         try:
-            if not UserDAO.user_exists(username):
-                raise KeyError(f"User {username} does not exist")
-            UserDAO.delete_user(username)
+            # the storage checks the user exists within the delete itself, so no check can go stale
+            if not UserDAO.remove_user(username):
+                raise KeyError(f"User {username} not found")
             return True
         except (ValueError, KeyError) as e:
             logging.error(f"Account deletion failed: {e}")
             raise
 
+    @staticmethod
+    def _read_import_file(path):
+        """
+        Read the rows of a JSONL or CSV file of users one at a time.
+
+        Yields:
+            tuple: Line number, row dictionary (None if unreadable) and error message
+        """
+        extension = os.path.splitext(path)[1].lower()
+        if extension not in (".csv", ".jsonl", ".ndjson"):
+            raise ValueError("Unsupported file type - use .jsonl or .csv")
+        with open(path, "r", newline="", encoding="utf-8") as source:
+            if extension == ".csv":
+                reader = csv.DictReader(source)
+                for row in reader:
+                    yield reader.line_num, row, None
+                return
+            for line_number, line in enumerate(source, 1):
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except json.JSONDecodeError as e:
+                    yield line_number, None, f"invalid JSON: {e}"
+                    continue
+                if isinstance(row, dict):
+                    yield line_number, row, None
+                else:
+                    yield line_number, None, "expected a JSON object"
+
+    @classmethod
+    def import_users(cls, path, workers=None, max_errors=10):
+        """
+        Register the users listed in a JSONL or CSV file with username, password, email
+        and optionally role fields. Rows are validated as they are read, users that
+        already exist or appear twice are skipped, passwords are hashed in parallel
+        and all new users are saved in a single database write. Users registered
+        while the passwords are being hashed are skipped too, not overwritten.
+
+        Args:
+            path (str): File to import
+            workers (int, optional): Processes used for password hashing
+            max_errors (int): Number of row errors to report
+
+        Returns:
+            dict: Counts of imported, skipped and invalid rows, and the first errors
+
+        Raises:
+            ValueError: If the file type is not supported
+            OSError: If the file can't be read or the database operation fails
+        """
+        existing = set(UserDAO.get_usernames())
+        emails = set()
+        users, passwords = [], []
+        summary = {"imported": 0, "skipped": 0, "invalid": 0, "errors": []}
+        for line_number, row, error in cls._read_import_file(path):
+            if row is not None:
+                username, password, email = row.get("username"), row.get("password"), row.get("email")
+                role = row.get("role") or "user"
+                try:
+                    cls._validate(username, password, email, role)
+                except (TypeError, ValueError) as e:
+                    error = str(e)
+            if error is None and username in existing:
+                summary["skipped"] += 1
+                continue
+            if error is None and (email in emails or UserDAO.email_registered(email)):
+                error = f"email {email} is already registered"
+            if error is not None:
+                summary["invalid"] += 1
+                if len(summary["errors"]) < max_errors:
+                    summary["errors"].append(f"line {line_number}: {error}")
+                continue
+            existing.add(username)
+            emails.add(email)
+            users.append({"username": username, "email": email, "role": role})
+            passwords.append(password)
+        for user_data, password_hash in zip(users, UserDAO.hash_passwords(passwords, workers)):
+            user_data["password_hash"] = password_hash
+        try:
+            # insert-only: a user registered while the passwords were being hashed isn't overwritten
+            saved = UserDAO.save_users(users, only_new=True)
+        except (TypeError, ValueError, OSError) as e:
+            logging.error(f"User import from {path} failed: {e}")
+            raise
+        summary["imported"] = len(saved)
+        summary["skipped"] += len(users) - len(saved)
+        logging.info(f"Imported {len(saved)} users from {path}")
+        return summary
+
+    @staticmethod
+    def filter(role=None, email=None, email_prefix=None, limit=100):
+        """
+        Fetch the users with the given role and/or email, using the storage indexes.
+
+        Args:
+            role (str, optional): Role the users must have
+            email (str, optional): Email the users must have
+            email_prefix (str, optional): Prefix the users' email must start with
+            limit (int, optional): Maximum number of users to return
+
+        Returns:
+            dict: User data keyed by username, in username order
+
+        Raises:
+            ValueError: If no criteria are given or they are invalid
+        """
+        try:
+            return UserDAO.find_users(role=role, email=email, email_prefix=email_prefix, limit=limit)
+        except ValueError as e:
+            logging.error(f"Failed to filter users: {e}")
+            raise
+
+    @staticmethod
+    def find(pattern):
+        """
+        Find usernames matching a shell-style pattern, e.g. "test_*".
+
+        Returns:
+            list: Matching usernames in sorted order
+        """
+        return sorted(username for username in UserDAO.get_usernames() if fnmatch.fnmatchcase(username, pattern))
+
+    @staticmethod
+    def delete_many(usernames):
+        """
+        Remove several user accounts in a single database write.
+
+        Returns:
+            list: The usernames that were deleted
+        """
+        try:
+            return UserDAO.delete_users(usernames)
+        except OSError as e:
+            logging.error(f"Bulk account deletion failed: {e}")
+            raise
+
     @staticmethod
     def get(username=None):
         """
@@ -149,6 +421,66 @@ class User:
             logging.error(f"Failed to retrieve user data: {e}")
             raise
 
+    @staticmethod
+    def encode_cursor(username):
+        """Return the opaque page cursor continuing after username"""
+        return base64.urlsafe_b64encode(username.encode("utf-8")).decode("ascii").rstrip("=")
+
+    @staticmethod
+    def decode_cursor(cursor):
+        """
+        Return the username a page cursor continues after.
+
+        Raises:
+            ValueError: If the cursor is malformed
+        """
+        try:
+            username = base64.b64decode(cursor + "=" * (-len(cursor) % 4), altchars="-_", validate=True)
+            return username.decode("utf-8")
+        except (binascii.Error, UnicodeDecodeError, TypeError) as e:
+            raise ValueError("Invalid cursor") from e
+
+    @classmethod
+    def get_page(cls, cursor=None, page_size=50):
+        """
+        Fetch a page of user records in username order.
+
+        Args:
+            cursor (str, optional): Cursor returned with the previous page
+            page_size (int): Maximum number of records on the page
+
+        Returns:
+            tuple: User data keyed by username, and the cursor of the next page
+                (None on the last page)
+
+        Raises:
+            ValueError: If the cursor or page size is invalid
+        """
+        after = cls.decode_cursor(cursor) if cursor else None
+        page = UserDAO.get_users_page(after, page_size + 1)
+        if len(page) <= page_size:
+            return page, None
+        page.popitem()
+        return page, cls.encode_cursor(next(reversed(page)))
+
+    @staticmethod
+    def iter_pages(page_size=100):
+        """
+        Iterate over all user records a page at a time, so only one page is held in
+        memory however many users there are.
+
+        Yields:
+            dict: Up to page_size user records keyed by username
+        """
+        after = None
+        while True:
+            page = UserDAO.get_users_page(after, page_size)
+            if page:
+                yield page
+            if len(page) < page_size:
+                return
+            after = next(reversed(page))
+
     def send_message(self, recipient, message):
         """
         Send a message to another user.